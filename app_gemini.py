@@ -1,21 +1,51 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-from pybit.unified_trading import HTTP
+from flask import Flask, render_template, request, jsonify, redirect, url_for, Response, stream_with_context, g
+from pybit.unified_trading import HTTP, WebSocket
+from pybit.exceptions import FailedRequestError, InvalidRequestError
+import requests
 from decimal import Decimal
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import os
+import socket
+import uuid
 from dotenv import load_dotenv
 import logging
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 import json
 import time
-from dataclasses import dataclass
+import random
+import zlib
+import gzip
+import hashlib
+import copy
+import functools
+import atexit
+import signal
+import sqlite3
+import io
+import csv
+import click
+import queue
+import threading
+import bisect
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass, field
+import numpy as np
+try:
+    import brotli # volitelné; bez něj se odpovědi komprimují jen gzipem
+except ImportError:
+    brotli = None
 
 # SQLAlchemy importy
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import desc
+from sqlalchemy import desc, insert, update, and_, or_, func, cast, Float, inspect, text, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import case
 
 # APScheduler import
 from flask_apscheduler import APScheduler
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
 
 # Nastavení loggingu (beze změny)
 logging.basicConfig(
@@ -27,7 +57,16 @@ logging.basicConfig(
     ]
 )
 
-# Dataclass pro konfiguraci obchodování (beze změny)
+# Úroveň retence: snapshoty starší než after_days se proředí na úseky `resolution`
+# ('1h', '1d', '1w'); v každém úseku zůstanou snapshoty podle `keep`
+# ('first', 'last', 'extremes' = minimum a maximum equity)
+@dataclass
+class RetentionTier:
+    after_days: int
+    resolution: str
+    keep: Tuple[str, ...] = ('last',)
+
+# Dataclass pro konfiguraci obchodování
 @dataclass
 class TradingConfig:
     testnet: bool = False
@@ -36,76 +75,628 @@ class TradingConfig:
     time_in_force: str = "GTC"
     # Nová konfigurace pro plánovač
     scheduler_interval_minutes: int = 15 # Výchozí interval 60 minut (1 hodina)
+    # Jak dlouho (v sekundách) se sdílí odpověď get_positions/get_wallet_balance, 0 = bez cache
+    cache_ttl_seconds: float = 5.0
+    # Maximální doba čekání na pozice/zůstatek při pořizování snapshotu (sekundy)
+    snapshot_timeout_seconds: float = 10.0
+    # Živé pozice přes privátní WebSocket; ws_url přepíše adresu (např. lokální fake server)
+    live_stream_enabled: bool = True
+    ws_url: Optional[str] = None
+    # Adresa REST API; přepisuje výchozí Bybit endpoint (např. lokální náhrada v benchmark.py)
+    rest_url: Optional[str] = None
+    # Ukládání pozic snapshotu: 'delta' = komprimovaný keyframe + delty, 'json' = celé positions_json
+    snapshot_storage: str = "delta"
+    # Kolik dní zpět se pozice ukládají i do normalizované tabulky position_item
+    # (historie symbolu, export pozic); starší řádky maže kompakce. 0 = nezapisovat.
+    # Úplné pozice jsou vždy v positions_blob/positions_json záznamu.
+    position_items_days: int = 7
+    # Po kolika snapshotech se zapíše nový keyframe (96 = jeden den při 15min intervalu)
+    snapshot_keyframe_interval: int = 96
+    # Write-behind fronta pro ukládání snapshotů do DB
+    write_queue_size: int = 1000
+    write_batch_size: int = 100
+    write_flush_interval_seconds: float = 0.5
+    # Kolektor snapshotů pro více účtů a settle coinů
+    settle_coins: List[str] = field(default_factory=lambda: ["USDT"])
+    collector_max_workers: int = 32
+    # Rozpočet požadavků na API pro jeden účet (token bucket)
+    account_requests_per_second: float = 10.0
+    account_request_burst: int = 10
+    # Limity jednotlivých endpointů (požadavků/s); upřesňují se z hlaviček odpovědí
+    endpoint_rate_limits: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_ENDPOINT_LIMITS))
+    # Opakování dočasných chyb s exponenciálním backoffem a jitterem
+    request_max_retries: int = 3
+    request_backoff_seconds: float = 0.25
+    request_backoff_max_seconds: float = 4.0
+    # Velikost poolu keep-alive HTTP spojení jedné session
+    http_pool_size: int = 32
+    # Maximální počet objednávek v jednom place_batch_order (Bybit: 20 pro linear/inverse)
+    batch_order_limit: int = 20
+    # Počet souběžně stahovaných oken při backfillu historie
+    backfill_workers: int = 8
+    # Retence historie: plné rozlišení 7 dní, pak hodinové, po 90 dnech denní úseky
+    retention_enabled: bool = True
+    retention_tiers: List[RetentionTier] = field(default_factory=lambda: [
+        RetentionTier(7, '1h', ('last',)),
+        RetentionTier(90, '1d', ('first', 'last', 'extremes'))
+    ])
+    retention_interval_hours: int = 24
+    # Počet záznamů smazaných v jedné transakci a stránek uvolněných jedním krokem incremental_vacuum
+    retention_batch_size: int = 500
+    retention_vacuum_pages: int = 256
+    # Komprese HTTP odpovědí: menší odpovědi se posílají beze změny
+    compress_min_bytes: int = 1024
+    compress_level: int = 6
+    # Platnost lease kolektoru (sekundy); obnovuje se po třetině této doby
+    collector_lease_seconds: int = 60
+    # Ukládat snapshot i při ručním načtení /positions. Vypnuto, pokud zapisuje samostatný
+    # kolektor (run-collector): webové workery pak jen čtou a nespouštějí write-behind vlákno
+    manual_snapshot_save: bool = False
+    # Port, na kterém run-collector vystavuje /metrics (0 = vypnuto)
+    collector_metrics_port: int = 9101
+
+# Výchozí limity Bybit V5 na UID a endpoint (požadavků za sekundu)
+DEFAULT_ENDPOINT_LIMITS = {
+    'get_wallet_balance': 50,
+    'get_positions': 50,
+    'set_leverage': 10,
+    'place_order': 10,
+    'place_batch_order': 10,
+    'get_executions': 10,
+    'get_closed_pnl': 10,
+    'get_mark_price_kline': 50,
+    'get_instruments_info': 10
+}
+
+# Název účtu, pod kterým se ukládají snapshoty klíčů BYBIT_API_KEY/BYBIT_API_SECRET
+DEFAULT_ACCOUNT = "main"
+
+# --- Metriky (Prometheus text format) ---
+# Jednoduchý registr bez externí závislosti. Zápis metriky je jeden zámek
+# a pár aritmetických operací; text pro /metrics se skládá až při scrapu.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(list(zip(self.label_names, key)))} {value}" for key, value in values]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class CallbackMetric(_Metric):
+    # Hodnoty se čtou až při scrapu z callbacku, který vrací [(labely, hodnota)]
+    def __init__(self, name: str, documentation: str, kind: str, callback):
+        super().__init__(name, documentation)
+        self.kind = kind
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(sorted(labels.items()))} {value}" for labels, value in self.callback()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            pairs = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names))
+
+    def callback(self, name: str, documentation: str, kind: str, callback) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, kind, callback))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.render()
+            except Exception as e:
+                logging.warning(f"Metrika {metric.name} se nepodařilo vyhodnotit: {e}")
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+bybit_request_seconds = metrics.histogram(
+    'bybit_request_duration_seconds', "Doba jednoho HTTP požadavku na Bybit API.", ('endpoint',))
+bybit_request_errors = metrics.counter(
+    'bybit_request_errors_total', "Chybné odpovědi Bybit API podle kódu.", ('endpoint', 'code'))
+bybit_request_retries = metrics.counter(
+    'bybit_request_retries_total', "Opakované požadavky na Bybit API.", ('endpoint',))
+bybit_rate_limit_wait_seconds = metrics.histogram(
+    'bybit_rate_limit_wait_seconds', "Čekání na token rate limitu před odesláním požadavku.", ('endpoint',))
+trader_method_seconds = metrics.histogram(
+    'trader_method_duration_seconds', "Doba volání metod BybitTrader (včetně cache).", ('account', 'method'))
+trader_method_errors = metrics.counter(
+    'trader_method_errors_total', "Výjimky z metod BybitTrader.", ('account', 'method'))
+http_request_seconds = metrics.histogram(
+    'http_request_duration_seconds', "Doba zpracování HTTP požadavku (u streamů do začátku odpovědi).",
+    ('route', 'method', 'status'))
+db_write_seconds = metrics.histogram(
+    'db_write_duration_seconds', "Doba zápisu dávky snapshotů včetně commitu.", ())
+db_records_written = metrics.counter(
+    'db_records_written_total', "Zapsané záznamy position_record.", ())
+db_write_errors = metrics.counter(
+    'db_write_errors_total', "Neúspěšné zápisy snapshotů.", ())
+scheduler_job_seconds = metrics.histogram(
+    'scheduler_job_duration_seconds', "Doba běhu naplánované úlohy.", ('job',))
+scheduler_job_errors = metrics.counter(
+    'scheduler_job_errors_total', "Chyby naplánovaných úloh (včetně nenačtených účtů).", ('job',))
+scheduler_job_lag_seconds = metrics.histogram(
+    'scheduler_job_lag_seconds', "Zpoždění spuštění úlohy oproti plánovanému času.", ('job',))
+scheduler_missed_runs = metrics.counter(
+    'scheduler_missed_runs_total', "Vynechaná spuštění úlohy.", ('job', 'reason'))
+scheduler_last_success = metrics.gauge(
+    'scheduler_last_success_timestamp_seconds', "Unix čas posledního úspěšného běhu úlohy.", ('job',))
+retention_records_deleted = metrics.counter(
+    'retention_records_deleted_total', "Záznamy position_record odstraněné kompakcí historie.", ())
+retention_bytes_reclaimed = metrics.counter(
+    'retention_bytes_reclaimed_total', "Bajty uvolněné ze souboru DB po kompakci.", ())
+
+
+def instrumented_trader_method(func):
+    # Latence a chyby metody BybitTrader s labely účtu a názvu metody
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        except Exception:
+            trader_method_errors.inc(account=self.account, method=func.__name__)
+            raise
+        finally:
+            trader_method_seconds.observe(time.perf_counter() - started, account=self.account, method=func.__name__)
+    return wrapper
+
+
+# Krátkodobá cache s "single-flight" chováním: souběžná volání se stejným klíčem
+# počkají na jeden společný požadavek na API místo toho, aby každé volalo Bybit zvlášť.
+class SingleFlightCache:
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}    # klíč -> (čas expirace, hodnota)
+        self._in_flight = {}  # klíč -> Future probíhajícího požadavku
+        self._generation = 0  # zvýší se při invalidaci, aby se neuložil zastaralý výsledek
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+                generation = self._generation
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_owner:
+            return copy.deepcopy(future.result())
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if generation == self._generation and self.ttl_seconds > 0:
+                self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        future.set_result(value)
+        return copy.deepcopy(value)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+                self._in_flight.clear()
+            else:
+                self._entries.pop(key, None)
+                self._in_flight.pop(key, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            requests_total = self.hits + self.misses + self.coalesced
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': round((self.hits + self.coalesced) / requests_total, 4) if requests_total else 0.0,
+                'ttl_seconds': self.ttl_seconds
+            }
+
+# Token bucket: nejvýše `rate` požadavků za sekundu s krátkodobou rezervou `capacity`.
+# acquire() blokuje, dokud není token k dispozici.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+        self._paused_until = 0.0
+
+    def acquire(self, tokens: float = 1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait_seconds = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return
+                    wait_seconds = (tokens - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def pause(self, seconds: float):
+        # Žádné tokeny až do uplynutí `seconds` (např. do resetu limitu na serveru)
+        with self._lock:
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def sync(self, limit: float, remaining: float, reset_in: float):
+        """
+        Srovná stav s hlavičkami X-Bapi-Limit, X-Bapi-Limit-Status a
+        X-Bapi-Limit-Reset-Timestamp: server je autorita, lokální odhad se
+        může jen zpřísnit.
+        """
+        with self._lock:
+            if limit > 0 and limit != self.capacity:
+                self.rate = self.capacity = float(limit)
+            self._tokens = min(self._tokens, float(remaining))
+        if remaining <= 0 and reset_in > 0:
+            self.pause(reset_in)
+
+
+# --- Odesílání požadavků na Bybit API ---
+# retCode, u kterých Bybit požadavek odmítl kvůli rate limitu (nebyl proveden)
+RATE_LIMIT_RET_CODES = {10006, 10429}
+# Dočasné chyby serveru; opakují se jen u idempotentních požadavků
+RETRYABLE_RET_CODES = {10000, 10016}
+RETRYABLE_HTTP_STATUSES = {500, 502, 503, 504}
+
+
+def _limit_reset_in(headers) -> float:
+    # X-Bapi-Limit-Reset-Timestamp je v milisekundách (UTC)
+    try:
+        return int(headers['X-Bapi-Limit-Reset-Timestamp']) / 1000 - time.time()
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+class RequestDispatcher:
+    """
+    Všechna volání pybit session jdou přes call(). Každý endpoint má vlastní
+    TokenBucket synchronizovaný s hlavičkami rate limitu z odpovědí, takže
+    dávky požadavků čekají lokálně místo chyb 10006. Dočasné chyby se
+    opakují s exponenciálním backoffem a jitterem.
+    """
+    def __init__(self, session: HTTP, config: TradingConfig, account_budget: TokenBucket):
+        self.session = session
+        self.config = config
+        self.account_budget = account_budget
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.rate_limited = 0
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        with self._lock:
+            if endpoint not in self._buckets:
+                limit = self.config.endpoint_rate_limits.get(endpoint, self.config.account_requests_per_second)
+                self._buckets[endpoint] = TokenBucket(limit, limit)
+            return self._buckets[endpoint]
+
+    def call(self, endpoint: str, idempotent: bool = True, **params) -> Dict:
+        """
+        Zavolá metodu session `endpoint`. Neidempotentní požadavky (objednávky)
+        se opakují jen tehdy, když je server prokazatelně nezpracoval (rate limit).
+        """
+        method = getattr(self.session, endpoint)
+        bucket = self.bucket(endpoint)
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            self.account_budget.acquire()
+            bucket.acquire()
+            sent = time.perf_counter()
+            bybit_rate_limit_wait_seconds.observe(sent - started, endpoint=endpoint)
+            try:
+                response = method(**params)
+            except (InvalidRequestError, FailedRequestError, requests.exceptions.RequestException) as e:
+                bybit_request_seconds.observe(time.perf_counter() - sent, endpoint=endpoint)
+                bybit_request_errors.inc(endpoint=endpoint, code=getattr(e, 'status_code', None) or type(e).__name__)
+                delay = self._retry_delay(e, bucket, idempotent, attempt)
+                if delay is None or attempt >= self.config.request_max_retries:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                bybit_request_retries.inc(endpoint=endpoint)
+                logging.warning(f"Požadavek {endpoint} selhal ({e}), opakuji za {delay:.2f} s "
+                                f"(pokus {attempt}/{self.config.request_max_retries}).")
+                time.sleep(delay)
+                continue
+
+            bybit_request_seconds.observe(time.perf_counter() - sent, endpoint=endpoint)
+            if isinstance(response, tuple):
+                # Session vrací (odpověď, doba trvání, hlavičky), viz return_response_headers
+                response, _, headers = response
+                self._sync_bucket(bucket, headers)
+            return response
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'endpoints': {name: bucket.rate for name, bucket in self._buckets.items()}
+            }
 
-# Třída pro interakci s Bybit API (beze změny, jen pro úplnost)
+    @staticmethod
+    def _sync_bucket(bucket: TokenBucket, headers):
+        try:
+            limit = int(headers['X-Bapi-Limit'])
+            remaining = int(headers['X-Bapi-Limit-Status'])
+        except (KeyError, TypeError, ValueError):
+            return
+        bucket.sync(limit, remaining, _limit_reset_in(headers))
+
+    def _retry_delay(self, error: Exception, bucket: TokenBucket, idempotent: bool, attempt: int) -> Optional[float]:
+        status = getattr(error, 'status_code', None)
+        if (isinstance(error, InvalidRequestError) and status in RATE_LIMIT_RET_CODES) or \
+                (isinstance(error, FailedRequestError) and status in (403, 429)):
+            # Odmítnuto rate limitem: endpoint se pozastaví do resetu limitu
+            with self._lock:
+                self.rate_limited += 1
+            bucket.pause(max(_limit_reset_in(error.resp_headers), 0.0))
+        elif not idempotent:
+            return None
+        elif isinstance(error, InvalidRequestError) and status not in RETRYABLE_RET_CODES:
+            return None
+        elif isinstance(error, FailedRequestError) and status not in RETRYABLE_HTTP_STATUSES:
+            return None
+        # "Full jitter": náhodné čekání z intervalu <0, backoff>
+        backoff = min(self.config.request_backoff_max_seconds, self.config.request_backoff_seconds * 2 ** attempt)
+        return random.uniform(0, backoff)
+
+# Třída pro interakci s Bybit API
 class BybitTrader:
-    def __init__(self, config: TradingConfig):
+    def __init__(
+        self,
+        config: TradingConfig,
+        account: str = DEFAULT_ACCOUNT,
+        api_key: Optional[str] = None,
+        api_secret: Optional[str] = None
+    ):
         load_dotenv()
-        self.api_key = os.getenv('BYBIT_API_KEY')
-        self.api_secret = os.getenv('BYBIT_API_SECRET')
+        self.account = account
+        # Výchozí klíče z .env patří jen hlavnímu účtu; podúčet bez vlastních klíčů se nevytvoří
+        if account == DEFAULT_ACCOUNT:
+            api_key = api_key or os.getenv('BYBIT_API_KEY')
+            api_secret = api_secret or os.getenv('BYBIT_API_SECRET')
+        self.api_key = api_key
+        self.api_secret = api_secret
 
         if not self.api_key or not self.api_secret:
-            logging.error("API klíče nejsou nastaveny v .env souboru.")
-            raise ValueError("API klíče nejsou nastaveny v .env souboru")
+            logging.error(f"API klíče účtu {account} nejsou nastaveny v .env souboru.")
+            raise ValueError(f"API klíče účtu {account} nejsou nastaveny v .env souboru")
 
         self.config = config
         self.session = self._initialize_session()
+        self.cache = SingleFlightCache(config.cache_ttl_seconds)
+        self.rate_budget = TokenBucket(config.account_requests_per_second, config.account_request_burst)
+        self.dispatcher = RequestDispatcher(self.session, config, self.rate_budget)
+        # Aktuální pozice podle symbolu (z načtení pozic, WebSocketu a zavíracích objednávek)
+        self.book = PositionBook()
+        # Poslední známá páka podle symbolu; set_leverage se volá jen při změně
+        self._leverage: Dict[str, int] = {}
+        self._leverage_lock = threading.Lock()
 
     def _initialize_session(self) -> HTTP:
-        return HTTP(
+        session = HTTP(
             api_key=self.api_key,
             api_secret=self.api_secret,
-            testnet=self.config.testnet
+            testnet=self.config.testnet,
+            # Opakování a rate limity řídí RequestDispatcher; pybit si ponechá
+            # jen okamžité opakování s delším recv_window (10002)
+            retry_codes={10002},
+            max_retries=2,
+            retry_delay=0,
+            return_response_headers=True
         )
-
-    def get_account_balance(self) -> Dict:
+        if self.config.rest_url:
+            session.endpoint = self.config.rest_url.rstrip('/')
+        # Výchozí pool requests drží 10 spojení; souběžná volání kolektoru by
+        # jinak otevírala nová TLS spojení
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.config.http_pool_size)
+        session.client.mount('https://', adapter)
+        session.client.mount('http://', adapter)
+        return session
+
+    @instrumented_trader_method
+    def get_account_balance(self, use_cache: bool = True) -> Dict:
+        if not use_cache:
+            return self._fetch_account_balance()
+        return self.cache.get('balance', self._fetch_account_balance)
+
+    def _fetch_account_balance(self) -> Dict:
         try:
-            response = self.session.get_wallet_balance(accountType="UNIFIED")
+            response = self.dispatcher.call('get_wallet_balance', accountType="UNIFIED")
             balances = response.get("result", {}).get("list", [])
             if not balances:
                 logging.warning("Žádné zůstatky účtu nalezeny.")
                 return {}
 
-            balance_info = {
-                'total_equity': balances[0].get('totalEquity', 'N/A'),
-                'available_balance': balances[0].get('availableBalance', 'N/A'),
-                'totalMargin': balances[0].get('totalMargin', 'N/A'),
-                'totalWalletBalance': balances[0].get('totalWalletBalance', 'N/A'),
-                'coins': []
-            }
-            for coin in balances[0].get('coin', []):
-                balance_info['coins'].append({
-                    'name': coin.get('coin', 'Unknown'),
-                    'balance': coin.get('walletBalance', 'N/A')
-                })
-            return balance_info
+            return self.normalize_balance(balances[0])
         except Exception as e:
             logging.error(f"Chyba při získávání zůstatku: {e}")
             raise
 
-    def get_open_positions(self, settlement_currency: str = "USDT") -> List[Dict]:
+    @staticmethod
+    def normalize_balance(account: Dict) -> Dict:
+        # Stejný formát pro REST odpověď i WebSocket topic "wallet"
+        balance_info = {
+            'total_equity': account.get('totalEquity', 'N/A'),
+            'available_balance': account.get('availableBalance', 'N/A'),
+            'totalMargin': account.get('totalMargin', 'N/A'),
+            'totalWalletBalance': account.get('totalWalletBalance', 'N/A'),
+            'coins': []
+        }
+        for coin in account.get('coin', []):
+            balance_info['coins'].append({
+                'name': coin.get('coin', 'Unknown'),
+                'balance': coin.get('walletBalance', 'N/A')
+            })
+        return balance_info
+
+    @instrumented_trader_method
+    def get_open_positions(self, settlement_currency: str = "USDT", use_cache: bool = True) -> List[Dict]:
+        if not use_cache:
+            return self._fetch_open_positions(settlement_currency)
+        return self.cache.get(('positions', settlement_currency), lambda: self._fetch_open_positions(settlement_currency))
+
+    def _fetch_open_positions(self, settlement_currency: str) -> List[Dict]:
         try:
-            response = self.session.get_positions(
+            response = self.dispatcher.call(
+                'get_positions',
                 category=self.config.default_category,
                 settleCoin=settlement_currency
             )
             positions = response.get("result", {}).get("list", [])
             if not positions:
                 logging.info("Žádné otevřené pozice.")
+                self.book.replace_positions([], scope=settlement_currency)
                 return []
-            return [{
-                'symbol': pos['symbol'],
-                'size': pos['size'],
-                'positionValue': pos['positionValue'],
-                'side': pos['side'],
-                'unrealized_pnl': pos['unrealisedPnl'],
-                'avgPrice': pos['avgPrice'],
-                'createdTime': datetime.fromtimestamp(int(pos['createdTime']) / 1000).strftime('%Y-%m-%d %H:%M:%S')
-            } for pos in positions]
+            for pos in positions:
+                self._remember_leverage(pos['symbol'], pos.get('leverage'))
+            positions = [self.normalize_position(pos) for pos in positions]
+            self.book.replace_positions(positions, scope=settlement_currency)
+            return positions
         except Exception as e:
             logging.error(f"Chyba při získávání pozic: {e}")
             raise
 
+    @staticmethod
+    def normalize_position(pos: Dict) -> Dict:
+        # Stejný formát pro REST odpověď i WebSocket topic "position"
+        return {
+            'symbol': pos['symbol'],
+            'size': pos['size'],
+            'positionValue': pos['positionValue'],
+            'side': pos['side'],
+            'unrealized_pnl': pos['unrealisedPnl'],
+            'avgPrice': pos.get('avgPrice', pos.get('entryPrice')),
+            'createdTime': datetime.fromtimestamp(int(pos.get('createdTime') or 0) / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    @instrumented_trader_method
     def open_position(
         self,
         symbol: str,
@@ -116,27 +707,14 @@ class BybitTrader:
     ) -> Dict:
         try:
             leverage = leverage or self.config.default_leverage
-
-            try:
-                self.session.set_leverage(
-                    category=self.config.default_category,
-                    symbol=symbol,
-                    buyLeverage=str(leverage),
-                    sellLeverage=str(leverage)
-                )
-            except Exception as e:
-                if "leverage not modified" in str(e):
-                    logging.info(f"Leverage pro {symbol} již byl nastaven, pokračuji dál.")
-                else:
-                    logging.error(f"Chyba při nastavování páky pro {symbol}: {e}")
-                    raise
-
-            time.sleep(0.5)
+            self.ensure_leverage(symbol, leverage)
 
             if price is None:
                 raise ValueError("Pro limit order musíte zadat cenu.")
 
-            response = self.session.place_order(
+            response = self.dispatcher.call(
+                'place_order',
+                idempotent=False,
                 category=self.config.default_category,
                 symbol=symbol,
                 side=side,
@@ -146,6 +724,7 @@ class BybitTrader:
                 timeInForce=self.config.time_in_force,
                 # positionIdx="1"  # Zakomentováno pro One-Way Mode
             )
+            self.cache.invalidate() # Pozice i zůstatek se objednávkou mění
 
             logging.info(f"Pozice úspěšně otevřena: {symbol} {side} {qty} za cenu {price}.")
             return response
@@ -154,24 +733,152 @@ class BybitTrader:
             logging.error(f"Chyba při otevírání pozice: {str(e)}")
             raise
 
-    def close_position(self, symbol: str, qty: float) -> Dict:
+    def _remember_leverage(self, symbol: str, leverage):
         try:
-            current_positions = self.get_open_positions()
-            position_to_close_side = None
-            for p in current_positions:
-                if p['symbol'] == symbol:
-                    position_to_close_side = p['side']
-                    break
-            
-            if position_to_close_side == "Buy":
-                close_side = "Sell"
-            elif position_to_close_side == "Sell":
-                close_side = "Buy"
+            value = int(Decimal(str(leverage)))
+        except (ArithmeticError, ValueError, TypeError):
+            return
+        with self._leverage_lock:
+            self._leverage[symbol] = value
+
+    @instrumented_trader_method
+    def ensure_leverage(self, symbol: str, leverage: int) -> bool:
+        """
+        Nastaví páku, pokud se liší od poslední známé hodnoty.
+        Vrací True, pokud bylo potřeba volat API.
+        """
+        with self._leverage_lock:
+            if self._leverage.get(symbol) == int(leverage):
+                return False
+        try:
+            self.dispatcher.call(
+                'set_leverage',
+                category=self.config.default_category,
+                symbol=symbol,
+                buyLeverage=str(leverage),
+                sellLeverage=str(leverage)
+            )
+        except Exception as e:
+            if "leverage not modified" in str(e):
+                logging.info(f"Leverage pro {symbol} již byl nastaven, pokračuji dál.")
             else:
-                logging.warning(f"Nelze určit stranu pozice pro zavření {symbol}. Používám 'Sell' (výchozí pro long pozici).")
-                close_side = "Sell" 
-
-            response = self.session.place_order(
+                logging.error(f"Chyba při nastavování páky pro {symbol}: {e}")
+                raise
+        self._remember_leverage(symbol, leverage)
+        return True
+
+    @instrumented_trader_method
+    def open_positions_batch(self, orders: List[Dict]) -> List[Dict]:
+        """
+        Otevře více limitních pozic najednou. Každá objednávka je dict se
+        symbol, side, qty, price a volitelně leverage. Páky se nastaví souběžně
+        (jen u symbolů, kde se mění), objednávky se odešlou přes place_batch_order
+        po nejvýše batch_order_limit kusech. Vrací výsledek pro každou objednávku
+        ve stejném pořadí.
+        """
+        results = [None] * len(orders)
+        legs = []
+        for index, order in enumerate(orders):
+            if not isinstance(order, dict) or not all(order.get(key) for key in ('symbol', 'side', 'qty', 'price')):
+                results[index] = {'symbol': order.get('symbol') if isinstance(order, dict) else None, 'success': False,
+                                  'message': "Pole symbol, side, qty a price jsou povinná."}
+                continue
+            try:
+                leverage = int(order.get('leverage') or self.config.default_leverage)
+                if leverage <= 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                results[index] = {'symbol': order['symbol'], 'success': False,
+                                  'message': "Páka musí být kladné celé číslo."}
+                continue
+            legs.append((index, order, leverage))
+
+        # Páka je per symbol; konfliktní požadavky v jedné dávce nelze splnit zároveň
+        leverage_by_symbol = {}
+        for index, order, leverage in legs:
+            leverage_by_symbol.setdefault(order['symbol'], set()).add(leverage)
+        leverage_errors = {
+            symbol: "Pro symbol jsou v dávce zadány různé páky."
+            for symbol, values in leverage_by_symbol.items() if len(values) > 1
+        }
+        pending = {symbol: values.pop() for symbol, values in leverage_by_symbol.items() if symbol not in leverage_errors}
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(len(pending), 8)) as executor:
+                futures = {symbol: executor.submit(self.ensure_leverage, symbol, leverage)
+                           for symbol, leverage in pending.items()}
+            for symbol, future in futures.items():
+                if future.exception() is not None:
+                    leverage_errors[symbol] = f"Chyba při nastavování páky: {future.exception()}"
+
+        submit = []
+        for index, order, _ in legs:
+            if order['symbol'] in leverage_errors:
+                results[index] = {'symbol': order['symbol'], 'success': False, 'message': leverage_errors[order['symbol']]}
+            else:
+                submit.append((index, order))
+
+        for start in range(0, len(submit), self.config.batch_order_limit):
+            chunk = submit[start:start + self.config.batch_order_limit]
+            request_list = [{
+                'symbol': order['symbol'],
+                'side': order['side'],
+                'orderType': "Limit",
+                'qty': str(order['qty']),
+                'price': str(order['price']),
+                'timeInForce': self.config.time_in_force
+            } for _, order in chunk]
+            try:
+                response = self.dispatcher.call(
+                    'place_batch_order',
+                    idempotent=False,
+                    category=self.config.default_category,
+                    request=request_list
+                )
+            except Exception as e:
+                logging.error(f"Chyba při hromadném otevírání pozic: {e}")
+                for index, order in chunk:
+                    results[index] = {'symbol': order['symbol'], 'success': False, 'message': str(e)}
+                continue
+
+            # result.list a retExtInfo.list jsou ve stejném pořadí jako požadavky
+            placed = response.get('result', {}).get('list', [])
+            statuses = response.get('retExtInfo', {}).get('list', [])
+            for position, (index, order) in enumerate(chunk):
+                info = placed[position] if position < len(placed) else {}
+                status = statuses[position] if position < len(statuses) else {}
+                results[index] = {
+                    'symbol': order['symbol'],
+                    'success': status.get('code', 0) == 0 and bool(info.get('orderId')),
+                    'orderId': info.get('orderId'),
+                    'message': status.get('msg', '')
+                }
+        self.cache.invalidate() # Pozice i zůstatek se objednávkami mění
+
+        succeeded = sum(1 for result in results if result['success'])
+        logging.info(f"Hromadné otevření pozic: {succeeded}/{len(orders)} objednávek přijato.")
+        return results
+
+    @instrumented_trader_method
+    def close_position(self, symbol: str, qty: Optional[float] = None) -> Dict:
+        """
+        Zavře pozici (celou, pokud qty není zadáno). Strana a velikost se berou
+        z knihy pozic; API se volá jen tehdy, když symbol v knize není.
+        """
+        try:
+            position = self.book.get(symbol)
+            if position is None:
+                # Kniha ještě nemusí znát nově otevřenou pozici
+                self.get_open_positions(use_cache=False)
+                position = self.book.get(symbol)
+            if position is None:
+                raise ValueError(f"Otevřená pozice pro {symbol} nebyla nalezena.")
+
+            close_side = "Sell" if position['side'] == "Buy" else "Buy"
+            qty = qty or float(position['size'])
+
+            response = self.dispatcher.call(
+                'place_order',
+                idempotent=False,
                 category=self.config.default_category,
                 symbol=symbol,
                 side=close_side,
@@ -181,32 +888,268 @@ class BybitTrader:
                 reduceOnly=True
                 # positionIdx="?" # Zakomentováno pro One-Way Mode
             )
+            self.cache.invalidate()
+            # Reduce-only market objednávka se vyplní okamžitě; WebSocket/REST stav později potvrdí
+            self.book.reduce_position(symbol, qty)
             logging.info(f"Pozice úspěšně zavřena: {symbol} {qty}.")
             return response
         except Exception as e:
             logging.error(f"Chyba při zavírání pozice: {str(e)}")
             raise
 
+    @instrumented_trader_method
+    def close_positions(self, side: Optional[str] = None) -> List[Dict]:
+        """
+        Zavře všechny pozice, případně jen jednu stranu ("Buy" = long, "Sell" = short).
+        Reduce-only objednávky se odesílají souběžně; vrací výsledek pro každý symbol.
+        """
+        if not self.book.ready:
+            self.get_open_positions(use_cache=False)
+        positions = self.book.positions(side)
+        if not positions:
+            return []
+
+        def close(position: Dict) -> Dict:
+            try:
+                response = self.close_position(position['symbol'], float(position['size']))
+                return {'symbol': position['symbol'], 'success': True,
+                        'orderId': response.get('result', {}).get('orderId')}
+            except Exception as e:
+                return {'symbol': position['symbol'], 'success': False, 'message': str(e)}
+
+        with ThreadPoolExecutor(max_workers=min(len(positions), 16)) as executor:
+            results = list(executor.map(close, positions))
+        logging.info(f"Hromadné zavření pozic: {sum(1 for r in results if r['success'])}/{len(results)} zavřeno.")
+        return results
+
+
+# --- Živý stav pozic (WebSocket) ---
+# Kniha pozic v paměti indexovaná symbolem. Změny rozesílá odběratelům
+# (SSE klientům) jako delty přes fronty.
+class PositionBook:
+    SUBSCRIBER_QUEUE_SIZE = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._positions = {} # symbol -> pozice ve formátu BybitTrader.normalize_position
+        self._scopes = {} # symbol -> settle coin, ze kterého REST načtení pozice pochází
+        self._wallet = {}
+        self._subscribers = []
+        self.ready = False # True po prvním kompletním načtení z REST API
+        self.version = 0 # zvyšuje se při každé změně pozic nebo zůstatku
+
+    def get(self, symbol: str) -> Optional[Dict]:
+        with self._lock:
+            return self._positions.get(symbol)
+
+    def positions(self, side: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            return [pos for pos in self._positions.values() if side is None or pos['side'] == side]
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                'type': 'snapshot',
+                'positions': list(self._positions.values()),
+                'wallet': self._wallet
+            }
+
+    def apply_positions(self, positions: List[Dict]):
+        # Delta z WebSocketu: nulová velikost znamená zavřenou pozici
+        changed, removed = [], []
+        with self._lock:
+            for pos in positions:
+                if float(pos['size'] or 0) == 0:
+                    self._scopes.pop(pos['symbol'], None)
+                    if self._positions.pop(pos['symbol'], None) is not None:
+                        removed.append(pos['symbol'])
+                elif self._positions.get(pos['symbol']) != pos:
+                    self._positions[pos['symbol']] = pos
+                    changed.append(pos)
+        self._publish_positions(changed, removed)
+
+    def replace_positions(self, positions: List[Dict], scope: Optional[str] = None):
+        """
+        Rekonciliace s kompletním seznamem z REST API. Se `scope` (settle coin)
+        se odstraňují jen pozice načtené dříve pro stejný settle coin.
+        """
+        incoming = {pos['symbol']: pos for pos in positions}
+        with self._lock:
+            if scope is None:
+                removed = [symbol for symbol in self._positions if symbol not in incoming]
+            else:
+                removed = [symbol for symbol, owner in self._scopes.items()
+                           if owner == scope and symbol not in incoming and symbol in self._positions]
+            changed = [pos for symbol, pos in incoming.items() if self._positions.get(symbol) != pos]
+            for symbol in removed:
+                del self._positions[symbol]
+                self._scopes.pop(symbol, None)
+            self._positions.update(incoming)
+            self._scopes.update((symbol, scope) for symbol in incoming)
+            self.ready = True
+        self._publish_positions(changed, removed)
+
+    def reduce_position(self, symbol: str, qty: float):
+        # Okamžitá úprava po reduce-only objednávce
+        with self._lock:
+            pos = self._positions.get(symbol)
+            if pos is None:
+                return
+            remaining = Decimal(str(pos['size'])) - Decimal(str(qty))
+            if remaining <= 0:
+                del self._positions[symbol]
+                self._scopes.pop(symbol, None)
+                changed, removed = [], [symbol]
+            else:
+                pos = dict(pos, size=str(remaining))
+                self._positions[symbol] = pos
+                changed, removed = [pos], []
+        self._publish_positions(changed, removed)
+
+    def update_wallet(self, balance: Dict):
+        with self._lock:
+            if balance == self._wallet:
+                return
+            self._wallet = balance
+        self._publish({'type': 'wallet', 'data': balance})
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def subscribe(self) -> queue.Queue:
+        subscription = queue.Queue(maxsize=self.SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: queue.Queue):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+
+    def _publish_positions(self, changed: List[Dict], removed: List[str]):
+        if changed or removed:
+            self._publish({'type': 'position', 'data': changed, 'removed': removed})
+
+    def _publish(self, event: Dict):
+        with self._lock:
+            self.version += 1
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                # Pomalý klient: zahodíme nevyřízené delty a pošleme mu celý stav znovu
+                try:
+                    while True:
+                        subscription.get_nowait()
+                except queue.Empty:
+                    pass
+                subscription.put_nowait({'type': 'resync'})
+
+
+class _PrivateWebSocket(WebSocket):
+    # pybit skládá adresu z konstant; kvůli testům proti lokálnímu serveru ji lze přepsat
+    def __init__(self, url: Optional[str] = None, **kwargs):
+        self._url_override = url
+        super().__init__(channel_type="private", **kwargs)
+
+    def _connect(self, url):
+        super()._connect(self._url_override or url)
+
+
+class LiveStateStream:
+    """
+    Odebírá privátní topicy "position" a "wallet" a promítá je do PositionBook.
+    """
+    def __init__(self, trader: BybitTrader, book: PositionBook, url: Optional[str] = None):
+        self.trader = trader
+        self.book = book
+        self.url = url
+        self.ws = None
+
+    def start(self):
+        self.ws = _PrivateWebSocket(
+            url=self.url,
+            testnet=self.trader.config.testnet,
+            api_key=self.trader.api_key,
+            api_secret=self.trader.api_secret
+        )
+        self.ws.position_stream(self._on_position)
+        self.ws.wallet_stream(self._on_wallet)
+        logging.info("Živý stream pozic a peněženky spuštěn.")
+
+    def stop(self):
+        if self.ws is not None:
+            self.ws.exit()
+            self.ws = None
+
+    @property
+    def running(self) -> bool:
+        return self.ws is not None
+
+    def _on_position(self, message: Dict):
+        # Výjimka z callbacku by v pybit ukončila celé WebSocket spojení
+        try:
+            category = self.trader.config.default_category
+            positions = [
+                BybitTrader.normalize_position(pos) for pos in message.get('data', [])
+                if pos.get('category', category) == category
+            ]
+            self.book.apply_positions(positions)
+            self.trader.cache.invalidate()
+        except Exception as e:
+            logging.error(f"Chyba při zpracování WebSocket zprávy position: {e}")
+
+    def _on_wallet(self, message: Dict):
+        try:
+            for account in message.get('data', []):
+                if account.get('accountType', 'UNIFIED') == 'UNIFIED':
+                    self.book.update_wallet(BybitTrader.normalize_balance(account))
+            self.trader.cache.invalidate('balance')
+        except Exception as e:
+            logging.error(f"Chyba při zpracování WebSocket zprávy wallet: {e}")
+
 
 # --- Flask Web Application ---
 app = Flask(__name__)
 
-# Konfigurace databáze SQLite
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///trading_history.db'
+# Konfigurace databáze SQLite (DATABASE_URL umožní jinou databázi, např. pro benchmark)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///trading_history.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
 
+# SQLite v režimu WAL: čtenáři (/history) neblokují zápis a naopak.
+# synchronous=NORMAL je ve WAL režimu bezpečné proti poškození DB a šetří fsync.
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute('PRAGMA cache_size=-20000') # ~20 MB
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
 # Konfigurace APScheduler
 app.config['SCHEDULER_API_ENABLED'] = True # Povolí API endpointy pro scheduler
 app.config['SCHEDULER_TIMEZONE'] = 'Europe/Prague' # Nastav časovou zónu (nebo jakoukoliv jinou)
 
 scheduler = APScheduler() # Inicializace scheduleru
 
-# Databázový model pro ukládání historie pozic (beze změny)
+# Databázový model pro ukládání historie pozic
 class PositionRecord(db.Model):
+    __table_args__ = (
+        db.Index('ix_position_record_account_timestamp', 'account', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    account = db.Column(db.String(50), default=DEFAULT_ACCOUNT)
     
     total_equity = db.Column(db.String(50))
     total_long_value = db.Column(db.String(50))
@@ -219,6 +1162,14 @@ class PositionRecord(db.Model):
     total_pnl = db.Column(db.String(50))
 
     positions_json = db.Column(db.Text)
+    # Kompaktní úložiště pozic (viz encode_keyframe/encode_delta); keyframe_id je
+    # NULL u keyframu, u delty odkazuje na keyframe, vůči kterému je uložena
+    positions_blob = db.Column(db.LargeBinary)
+    keyframe_id = db.Column(db.Integer)
+    # 'live' = pořízeno plánovačem/dashboardem, 'backfill' = zrekonstruováno z historie obchodů
+    source = db.Column(db.String(10), default='live')
+
+    items = db.relationship('PositionItem', backref='record', cascade='all, delete-orphan')
 
     def __repr__(self):
         return f"<PositionRecord {self.timestamp} - Equity: {self.total_equity}>"
@@ -226,6 +1177,7 @@ class PositionRecord(db.Model):
     def to_dict(self):
         return {
             'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            'account': self.account,
             'summary': {
                 'total_equity': self.total_equity,
                 'total_long_value': self.total_long_value,
@@ -237,98 +1189,2020 @@ class PositionRecord(db.Model):
                 'settlement_currency': self.settlement_currency,
                 'total_pnl': self.total_pnl
             },
-            'positions': json.loads(self.positions_json) if self.positions_json else []
+            'positions': load_positions(self.positions_json, self.positions_blob, self.keyframe_id)
+        }
+
+
+# Normalizovaná tabulka jednotlivých pozic snapshotu s číselnými sloupci,
+# aby šlo filtrovat a agregovat přímo v SQL (bez json.loads v Pythonu)
+class PositionItem(db.Model):
+    __table_args__ = (
+        db.Index('ix_position_item_symbol_timestamp', 'symbol', 'timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, db.ForeignKey('position_record.id', ondelete='CASCADE'), nullable=False, index=True)
+    # Kopie timestampu snapshotu kvůli indexu (symbol, timestamp) bez JOINu
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    symbol = db.Column(db.String(30), nullable=False)
+    side = db.Column(db.String(4), nullable=False)
+    size = db.Column(db.Float)
+    position_value = db.Column(db.Float)
+    unrealised_pnl = db.Column(db.Float)
+    avg_price = db.Column(db.Float)
+    created_time = db.Column(db.String(19))
+
+    def __repr__(self):
+        return f"<PositionItem {self.timestamp} - {self.symbol} {self.side} {self.size}>"
+
+    @staticmethod
+    def row_from_position(pos: Dict, timestamp: datetime, record_id: Optional[int] = None) -> Dict:
+        row = {
+            'timestamp': timestamp,
+            'symbol': pos['symbol'],
+            'side': pos['side'],
+            'size': float(pos['size']),
+            'position_value': float(pos['positionValue']),
+            'unrealised_pnl': float(pos['unrealized_pnl']),
+            'avg_price': float(pos['avgPrice']),
+            'created_time': pos.get('createdTime')
+        }
+        if record_id is not None:
+            row['record_id'] = record_id
+        return row
+
+
+# Agregované řady equity/PnL/expozice po časových úsecích (1h, 1d, 1w).
+# Aktualizují se inkrementálně při každém zápisu snapshotu, průměry expozice
+# se počítají ze součtů při čtení.
+class EquityRollup(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('account', 'settlement_currency', 'resolution', 'bucket_start', name='uq_equity_rollup_series_bucket'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(50), nullable=False)
+    settlement_currency = db.Column(db.String(10), nullable=False)
+    resolution = db.Column(db.String(3), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    samples = db.Column(db.Integer, nullable=False, default=0)
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+
+    equity_open = db.Column(db.Float)
+    equity_high = db.Column(db.Float)
+    equity_low = db.Column(db.Float)
+    equity_close = db.Column(db.Float)
+    pnl_open = db.Column(db.Float)
+    pnl_high = db.Column(db.Float)
+    pnl_low = db.Column(db.Float)
+    pnl_close = db.Column(db.Float)
+
+    long_value_sum = db.Column(db.Float, default=0.0)
+    short_value_sum = db.Column(db.Float, default=0.0)
+    long_percentage_sum = db.Column(db.Float, default=0.0)
+    short_percentage_sum = db.Column(db.Float, default=0.0)
+
+    def __repr__(self):
+        return f"<EquityRollup {self.resolution} {self.bucket_start} - Close: {self.equity_close}>"
+
+    def to_dict(self):
+        return {
+            'account': self.account,
+            'settlement_currency': self.settlement_currency,
+            'resolution': self.resolution,
+            'bucket_start': self.bucket_start.strftime('%Y-%m-%d %H:%M:%S'),
+            'samples': self.samples,
+            'equity': {'open': self.equity_open, 'high': self.equity_high, 'low': self.equity_low, 'close': self.equity_close},
+            'pnl': {'open': self.pnl_open, 'high': self.pnl_high, 'low': self.pnl_low, 'close': self.pnl_close},
+            'avg_long_value': self.long_value_sum / self.samples,
+            'avg_short_value': self.short_value_sum / self.samples,
+            'avg_long_percentage': self.long_percentage_sum / self.samples,
+            'avg_short_percentage': self.short_percentage_sum / self.samples
         }
 
 
+ROLLUP_RESOLUTIONS = ('1h', '1d', '1w')
+
+
+def rollup_bucket_start(timestamp: datetime, resolution: str) -> datetime:
+    if resolution == '1h':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution == '1d':
+        return day
+    if resolution == '1w':
+        return day - timedelta(days=day.weekday()) # týden začíná pondělím
+    raise ValueError(f"Neznámé rozlišení '{resolution}'.")
+
+
+def update_rollups(snapshots: List[Tuple[datetime, Dict, str]]):
+    """
+    Promítne snapshoty (timestamp, summary, účet) do tabulky equity_rollup pomocí
+    INSERT ... ON CONFLICT DO UPDATE. Volá se ve stejné transakci jako zápis
+    PositionRecord, commit provádí volající.
+    """
+    rows = []
+    for timestamp, summary, account in snapshots:
+        equity = float(summary['total_equity'])
+        pnl = float(summary['total_pnl'])
+        for resolution in ROLLUP_RESOLUTIONS:
+            rows.append({
+                'account': account,
+                'settlement_currency': summary['settlement_currency'],
+                'resolution': resolution,
+                'bucket_start': rollup_bucket_start(timestamp, resolution),
+                'samples': 1,
+                'first_timestamp': timestamp,
+                'last_timestamp': timestamp,
+                'equity_open': equity, 'equity_high': equity, 'equity_low': equity, 'equity_close': equity,
+                'pnl_open': pnl, 'pnl_high': pnl, 'pnl_low': pnl, 'pnl_close': pnl,
+                'long_value_sum': float(summary['total_long_value']),
+                'short_value_sum': float(summary['total_short_value']),
+                'long_percentage_sum': float(summary['long_percentage']),
+                'short_percentage_sum': float(summary['short_percentage'])
+            })
+    if not rows:
+        return
+
+    stmt = sqlite_insert(EquityRollup).values(rows)
+    new = stmt.excluded
+    is_earlier = new.first_timestamp < EquityRollup.first_timestamp
+    is_later = new.last_timestamp >= EquityRollup.last_timestamp
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['account', 'settlement_currency', 'resolution', 'bucket_start'],
+        set_={
+            'samples': EquityRollup.samples + new.samples,
+            'first_timestamp': func.min(EquityRollup.first_timestamp, new.first_timestamp),
+            'last_timestamp': func.max(EquityRollup.last_timestamp, new.last_timestamp),
+            'equity_open': case((is_earlier, new.equity_open), else_=EquityRollup.equity_open),
+            'equity_high': func.max(EquityRollup.equity_high, new.equity_high),
+            'equity_low': func.min(EquityRollup.equity_low, new.equity_low),
+            'equity_close': case((is_later, new.equity_close), else_=EquityRollup.equity_close),
+            'pnl_open': case((is_earlier, new.pnl_open), else_=EquityRollup.pnl_open),
+            'pnl_high': func.max(EquityRollup.pnl_high, new.pnl_high),
+            'pnl_low': func.min(EquityRollup.pnl_low, new.pnl_low),
+            'pnl_close': case((is_later, new.pnl_close), else_=EquityRollup.pnl_close),
+            'long_value_sum': EquityRollup.long_value_sum + new.long_value_sum,
+            'short_value_sum': EquityRollup.short_value_sum + new.short_value_sum,
+            'long_percentage_sum': EquityRollup.long_percentage_sum + new.long_percentage_sum,
+            'short_percentage_sum': EquityRollup.short_percentage_sum + new.short_percentage_sum
+        }
+    )
+    db.session.execute(stmt)
+
+
+def _rollup_rebuild_boundary() -> Optional[datetime]:
+    # Začátek prvního týdne, který kompakce historie nezasáhla (None = bez kompakce)
+    compacted_until = get_setting(COMPACTED_UNTIL_SETTING)
+    if compacted_until is None:
+        return None
+    compacted_until = datetime.fromisoformat(compacted_until)
+    week = rollup_bucket_start(compacted_until, '1w')
+    return week if week == compacted_until else week + timedelta(weeks=1)
+
+
+def rebuild_rollups(batch_size: int = 1000, full: bool = False) -> int:
+    """
+    Smaže a znovu sestaví equity_rollup ze záznamů position_record.
+    Úseky proředěné kompakcí historie se zachovají, protože z ponechaných
+    záznamů už přesně sestavit nejdou; full=True sestaví vše.
+    Vrací počet zpracovaných záznamů.
+    """
+    boundary = None if full else _rollup_rebuild_boundary()
+    rollups = db.session.query(EquityRollup)
+    if boundary is not None:
+        rollups = rollups.filter(EquityRollup.bucket_start >= boundary)
+    rollups.delete(synchronize_session=False)
+    processed = 0
+    last_id = 0
+    columns = [PositionRecord.id, PositionRecord.timestamp, PositionRecord.account, PositionRecord.settlement_currency] + [
+        getattr(PositionRecord, name) for name in HISTORY_NUMERIC_FIELDS
+    ]
+    while True:
+        rows = (
+            db.session.query(*columns)
+            .filter(PositionRecord.id > last_id, PositionRecord.timestamp >= (boundary or datetime.min))
+            .order_by(PositionRecord.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        update_rollups([
+            (
+                row.timestamp,
+                {'settlement_currency': row.settlement_currency or 'USDT', **{name: getattr(row, name) or '0' for name in HISTORY_NUMERIC_FIELDS}},
+                row.account or DEFAULT_ACCOUNT
+            )
+            for row in rows
+        ])
+        processed += len(rows)
+        last_id = rows[-1].id
+    db.session.commit()
+    return processed
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Znovu sestaví agregace equity/PnL/expozice (kromě úseků proředěných kompakcí)."""
+    processed = rebuild_rollups()
+    print(f"Zpracováno {processed} záznamů.")
+
+
+# --- Kompaktní ukládání pozic (keyframe + delty) ---
+# Keyframe obsahuje celý seznam pozic. Delta obsahuje pořadí pozic, pro pozice
+# beze změny strukturálních polí jen aktuální ocenění (positionValue, PnL) a celé
+# pozice jen u nových nebo změněných. Vše je zkomprimované zlibem.
+SNAPSHOT_STRUCTURAL_FIELDS = ('symbol', 'side', 'size', 'avgPrice', 'createdTime')
+SNAPSHOT_MARK_FIELDS = ('positionValue', 'unrealized_pnl')
+
+
+def _position_key(pos: Dict) -> str:
+    return f"{pos['symbol']}|{pos['side']}"
+
+
+def _pack_snapshot(payload: Dict) -> bytes:
+    return zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), 9)
+
+
+def _unpack_snapshot(blob: bytes) -> Dict:
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def encode_keyframe(positions: List[Dict]) -> bytes:
+    return _pack_snapshot({'positions': positions})
+
+
+def encode_delta(positions: List[Dict], keyframe_positions: List[Dict]) -> Optional[bytes]:
+    """
+    Vrátí deltu vůči keyframu, nebo None, pokud se změnila víc než polovina
+    pozic a vyplatí se zapsat nový keyframe.
+    """
+    base = {_position_key(pos): pos for pos in keyframe_positions}
+    order, marks, changed = [], [], {}
+    for pos in positions:
+        key = _position_key(pos)
+        order.append(key)
+        ref = base.get(key)
+        if ref is not None and ref.keys() == pos.keys() and all(ref[f] == pos[f] for f in SNAPSHOT_STRUCTURAL_FIELDS):
+            marks.append([pos[f] for f in SNAPSHOT_MARK_FIELDS])
+        else:
+            marks.append(None)
+            changed[key] = pos
+    if len(changed) * 2 > max(len(positions), 1):
+        return None
+    return _pack_snapshot({'order': order, 'marks': marks, 'changed': changed})
+
+
+def decode_snapshot(blob: bytes, keyframe_positions: Optional[List[Dict]] = None) -> List[Dict]:
+    payload = _unpack_snapshot(blob)
+    if 'positions' in payload:
+        return payload['positions']
+    base = {_position_key(pos): pos for pos in keyframe_positions or []}
+    positions = []
+    for key, mark in zip(payload['order'], payload['marks']):
+        if mark is None:
+            positions.append(payload['changed'][key])
+        else:
+            pos = dict(base[key])
+            pos.update(zip(SNAPSHOT_MARK_FIELDS, mark))
+            positions.append(pos)
+    return positions
+
+
+def _read_keyframe(keyframe_id: int) -> tuple:
+    blob = db.session.query(PositionRecord.positions_blob).filter(PositionRecord.id == keyframe_id).scalar()
+    if blob is None:
+        raise LookupError(f"Keyframe {keyframe_id} nenalezen.")
+    return tuple(decode_snapshot(blob))
+
+
+# Keyframy se nemění, dekódovaný obsah lze bezpečně cachovat. Velikost cache se
+# po načtení účtů nastaví podle počtu řad (účet × settle coin), viz níže.
+KEYFRAMES_PER_SERIES = 8
+_load_keyframe = functools.lru_cache(maxsize=32)(_read_keyframe)
+
+
+def load_positions(positions_json: Optional[str], positions_blob: Optional[bytes], keyframe_id: Optional[int]) -> List[Dict]:
+    """
+    Vrátí seznam pozic záznamu bez ohledu na způsob uložení.
+    """
+    if positions_json:
+        return json.loads(positions_json)
+    if positions_blob is None:
+        return []
+    if keyframe_id is None:
+        return decode_snapshot(positions_blob)
+    return decode_snapshot(positions_blob, [dict(pos) for pos in _load_keyframe(keyframe_id)])
+
+
+def _encode_positions(positions: List[Dict], keyframe: Optional[Tuple[int, List[Dict], int]]) -> Tuple[bytes, Optional[int]]:
+    # keyframe = (id, pozice, počet snapshotů od keyframu) nebo None
+    if keyframe is not None and keyframe[2] + 1 < config.snapshot_keyframe_interval:
+        delta = encode_delta(positions, keyframe[1])
+        if delta is not None:
+            return delta, keyframe[0]
+    return encode_keyframe(positions), None
+
+
+def _latest_keyframe(account: str, settlement_currency: str) -> Optional[Tuple[int, List[Dict], int]]:
+    # Každý účet a settle coin má vlastní řadu keyframů
+    series = and_(PositionRecord.account == account, PositionRecord.settlement_currency == settlement_currency)
+    # ORDER BY id DESC LIMIT 1 prochází od konce tabulky a skončí na prvním keyframu
+    keyframe_id = (
+        db.session.query(PositionRecord.id)
+        .filter(series, PositionRecord.positions_blob.isnot(None), PositionRecord.keyframe_id.is_(None))
+        .order_by(desc(PositionRecord.id))
+        .limit(1)
+        .scalar()
+    )
+    if keyframe_id is None:
+        return None
+    since = db.session.query(func.count(PositionRecord.id)).filter(series, PositionRecord.id > keyframe_id).scalar()
+    return keyframe_id, list(_load_keyframe(keyframe_id)), since
+
+
+def encode_legacy_snapshots(batch_size: int = 500) -> int:
+    """
+    Převede záznamy s positions_json na keyframe/delta úložiště.
+    Vrací počet převedených záznamů.
+    """
+    converted = 0
+    keyframes = {} # (účet, settle coin) -> (id, pozice, počet snapshotů od keyframu)
+    last_id = 0
+    while True:
+        rows = (
+            db.session.query(PositionRecord.id, PositionRecord.positions_json, PositionRecord.account, PositionRecord.settlement_currency)
+            .filter(PositionRecord.id > last_id, PositionRecord.positions_json.isnot(None))
+            .order_by(PositionRecord.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        updates = []
+        for record_id, positions_json, account, settlement_currency in rows:
+            positions = json.loads(positions_json)
+            series = (account, settlement_currency)
+            keyframe = keyframes.get(series)
+            blob, keyframe_id = _encode_positions(positions, keyframe)
+            if keyframe_id is None:
+                keyframes[series] = (record_id, positions, 0)
+            else:
+                keyframes[series] = (keyframe[0], keyframe[1], keyframe[2] + 1)
+            updates.append({'id': record_id, 'positions_blob': blob, 'keyframe_id': keyframe_id, 'positions_json': None})
+        db.session.execute(update(PositionRecord), updates)
+        db.session.commit()
+        converted += len(updates)
+        last_id = rows[-1][0]
+    return converted
+
+
+@app.cli.command('encode-snapshots')
+def encode_snapshots_command():
+    """Převede starší záznamy s positions_json na komprimované keyframy a delty."""
+    converted = encode_legacy_snapshots()
+    # VACUUM nesmí běžet uvnitř transakce
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('VACUUM'))
+    print(f"Převedeno {converted} záznamů.")
+
+
+def build_position_record(summary: Dict, positions: List[Dict], timestamp: Optional[datetime] = None,
+                          account: str = DEFAULT_ACCOUNT,
+                          keyframe: Optional[Tuple[int, List[Dict], int]] = None) -> PositionRecord:
+    """
+    Sestaví PositionRecord včetně normalizovaných řádků PositionItem.
+    Bez `keyframe` se delta počítá vůči nejnovějšímu keyframu v DB.
+    """
+    now = timestamp or datetime.utcnow()
+    record = PositionRecord(
+        timestamp=now,
+        account=account,
+        total_equity=summary['total_equity'],
+        total_long_value=summary['total_long_value'],
+        total_short_value=summary['total_short_value'],
+        long_percentage=summary['long_percentage'],
+        short_percentage=summary['short_percentage'],
+        long_symbols=summary['long_symbols'],
+        short_symbols=summary['short_symbols'],
+        settlement_currency=summary['settlement_currency'],
+        total_pnl=summary['total_pnl']
+    )
+    if config.snapshot_storage == 'delta':
+        record.positions_blob, record.keyframe_id = _encode_positions(
+            positions, keyframe or _latest_keyframe(account, summary['settlement_currency'])
+        )
+    else:
+        record.positions_json = json.dumps(positions)
+    if now >= position_items_cutoff():
+        record.items = [PositionItem(**PositionItem.row_from_position(pos, now)) for pos in positions]
+    return record
+
+
+def position_items_cutoff(now: Optional[datetime] = None) -> datetime:
+    # Snapshoty starší než hranice nemají řádky position_item
+    if config.position_items_days <= 0:
+        return datetime.max
+    return (now or datetime.utcnow()) - timedelta(days=config.position_items_days)
+
+
+def _add_missing_columns(model):
+    table = model.__table__
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as connection:
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logging.info(f"Migrace: Přidán sloupec {table.name}.{column.name}.")
+
+
+def migrate_database(batch_size: int = 1000) -> int:
+    """
+    Vytvoří chybějící tabulky a indexy a doplní PositionItem řádky
+    pro starší záznamy (v okně position_items_days), které mají pozice jen v positions_json.
+    Vrací počet doplněných řádků.
+    """
+    # Kompakce historie uvolňuje místo přes incremental_vacuum; změna režimu vyžaduje jednorázový VACUUM
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if connection.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+            connection.execute(text('PRAGMA auto_vacuum=INCREMENTAL'))
+            connection.execute(text('VACUUM'))
+            logging.info("Migrace: Zapnut auto_vacuum=INCREMENTAL.")
+
+    # equity_rollup jsou odvozená data; chybějící tabulku nebo starší verzi (bez účtu) stačí sestavit znovu
+    inspector = inspect(db.engine)
+    rebuild_rollup_table = True
+    if inspector.has_table(EquityRollup.__tablename__):
+        rollup_columns = {column['name'] for column in inspector.get_columns(EquityRollup.__tablename__)}
+        rebuild_rollup_table = 'account' not in rollup_columns
+        if rebuild_rollup_table:
+            EquityRollup.__table__.drop(db.engine)
+    db.create_all()
+
+    # create_all nepřidává sloupce ani indexy do již existujících tabulek
+    for model in (PositionRecord, PositionItem):
+        _add_missing_columns(model)
+    for table in (PositionRecord.__table__, PositionItem.__table__):
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    db.session.query(PositionRecord).filter(PositionRecord.account.is_(None)).update(
+        {PositionRecord.account: DEFAULT_ACCOUNT}, synchronize_session=False
+    )
+    db.session.commit()
+    if rebuild_rollup_table:
+        if get_setting(COMPACTED_UNTIL_SETTING) is not None:
+            logging.warning("Migrace: Historie byla proředěna kompakcí, agregace starších úseků budou jen přibližné.")
+        logging.info(f"Migrace: Tabulka equity_rollup znovu sestavena z {rebuild_rollups(full=True)} záznamů.")
+
+    # Starší záznamy se procházejí po stránkách podle id, aby se nenačetly všechny najednou
+    inserted = 0
+    last_id = 0
+    while True:
+        pending = (
+            db.session.query(PositionRecord.id, PositionRecord.timestamp, PositionRecord.positions_json)
+            .outerjoin(PositionItem, PositionItem.record_id == PositionRecord.id)
+            .filter(PositionRecord.id > last_id, PositionItem.id.is_(None), PositionRecord.positions_json.isnot(None),
+                    PositionRecord.timestamp >= position_items_cutoff())
+            .order_by(PositionRecord.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not pending:
+            break
+        rows = []
+        for record_id, timestamp, positions_json in pending:
+            try:
+                positions = json.loads(positions_json)
+            except ValueError:
+                logging.warning(f"Migrace: Záznam {record_id} má neplatný positions_json, přeskočeno.")
+                continue
+            rows.extend(PositionItem.row_from_position(pos, timestamp, record_id) for pos in positions)
+        if rows:
+            db.session.execute(insert(PositionItem), rows)
+            inserted += len(rows)
+        db.session.commit()
+        last_id = pending[-1][0]
+
+    if inserted:
+        logging.info(f"Migrace: Doplněno {inserted} řádků position_item.")
+    return inserted
+
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Vytvoří schéma a doplní normalizované pozice do existující databáze."""
+    inserted = migrate_database()
+    print(f"Doplněno {inserted} řádků position_item.")
+
+
+# --- Agregace expozice a PnL ---
+# Sloupcová dávka pozic: jeden prvek pole = jedna pozice, snapshot_index určuje,
+# ke kterému snapshotu pozice patří. Součty se počítají v NumPy, na Decimal
+# se převádí a zaokrouhluje až výsledek.
+@dataclass
+class PositionBatch:
+    position_value: np.ndarray
+    unrealised_pnl: np.ndarray
+    is_long: np.ndarray
+    snapshot_index: np.ndarray
+
+    @classmethod
+    def from_positions(cls, positions: List[Dict]) -> 'PositionBatch':
+        count = len(positions)
+        return cls(
+            position_value=np.abs(np.fromiter((p['positionValue'] for p in positions), dtype=np.float64, count=count)),
+            unrealised_pnl=np.fromiter((p['unrealized_pnl'] for p in positions), dtype=np.float64, count=count),
+            is_long=np.fromiter((p['side'] == 'Buy' for p in positions), dtype=bool, count=count),
+            snapshot_index=np.zeros(count, dtype=np.intp)
+        )
+
+
+def _format_amount(value) -> str:
+    # Přes str(), aby se zaokrouhlovalo z nejkratší desetinné reprezentace floatu
+    return f"{Decimal(str(value)):.2f}"
+
+
+def _parse_equity(value) -> Decimal:
+    return Decimal(value) if value not in (None, '', 'N/A') else Decimal('0')
+
+
+def aggregate_exposure(batch: PositionBatch, equity: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Vrátí pole součtů long/short hodnoty, PnL a procent expozice pro každý
+    snapshot (délka = len(equity)).
+    """
+    snapshots = len(equity)
+    long_value = np.bincount(batch.snapshot_index, weights=np.where(batch.is_long, batch.position_value, 0.0), minlength=snapshots)
+    short_value = np.bincount(batch.snapshot_index, weights=np.where(batch.is_long, 0.0, batch.position_value), minlength=snapshots)
+    total_pnl = np.bincount(batch.snapshot_index, weights=batch.unrealised_pnl, minlength=snapshots)
+    return _exposure_totals(long_value, short_value, total_pnl, equity)
+
+
+def _exposure_totals(long_value: np.ndarray, short_value: np.ndarray, total_pnl: np.ndarray,
+                     equity: np.ndarray) -> Dict[str, np.ndarray]:
+    # Procenta expozice z již sečtených hodnot; při nulové equity je procento 0
+    has_equity = equity > 0
+    safe_equity = np.where(has_equity, equity, 1.0)
+    return {
+        'total_long_value': long_value,
+        'total_short_value': short_value,
+        'total_pnl': total_pnl,
+        'long_percentage': np.where(has_equity, long_value / safe_equity * 100, 0.0),
+        'short_percentage': np.where(has_equity, short_value / safe_equity * 100, 0.0)
+    }
+
+
+def summarize_positions(positions: List[Dict], balance_info: Dict, settlement_currency: str) -> Dict:
+    """
+    Souhrn jednoho snapshotu ve formátu ukládaném do PositionRecord.
+    """
+    total_equity = _parse_equity(balance_info.get('total_equity', '0'))
+    totals = aggregate_exposure(PositionBatch.from_positions(positions), np.array([float(total_equity)]))
+
+    return {
+        'total_long_value': _format_amount(totals['total_long_value'][0]),
+        'total_short_value': _format_amount(totals['total_short_value'][0]),
+        'long_percentage': _format_amount(totals['long_percentage'][0]),
+        'short_percentage': _format_amount(totals['short_percentage'][0]),
+        'long_symbols': ','.join(p['symbol'].replace('USDT', '') for p in positions if p['side'] == 'Buy'),
+        'short_symbols': ','.join(p['symbol'].replace('USDT', '') for p in positions if p['side'] != 'Buy'),
+        'settlement_currency': settlement_currency,
+        'total_pnl': _format_amount(totals['total_pnl'][0]),
+        'total_equity': f"{total_equity:.2f}"
+    }
+
+
+def recompute_history_summaries(batch_size: int = 5000) -> int:
+    """
+    Přepočítá číselné sloupce souhrnu (hodnoty, PnL, procenta) uložených
+    snapshotů z tabulky position_item. Součty se počítají v SQL (GROUP BY),
+    záznamy bez řádků position_item se přeskočí. Seznamy symbolů se nemění.
+    Uložený total_equity je zaokrouhlený na 2 místa, proto se procento expozice
+    přepočítává jen tam, kde se změnila příslušná hodnota.
+    Vrací počet aktualizovaných záznamů.
+    """
+    is_long = PositionItem.side == 'Buy'
+    updated = 0
+    last_id = 0
+    while True:
+        sums = (
+            db.session.query(
+                PositionItem.record_id.label('record_id'),
+                func.sum(case((is_long, func.abs(PositionItem.position_value)), else_=0.0)).label('long_value'),
+                func.sum(case((is_long, 0.0), else_=func.abs(PositionItem.position_value))).label('short_value'),
+                func.sum(PositionItem.unrealised_pnl).label('total_pnl')
+            )
+            .filter(PositionItem.record_id > last_id)
+            .group_by(PositionItem.record_id)
+            .order_by(PositionItem.record_id)
+            .limit(batch_size)
+            .subquery()
+        )
+        records = (
+            db.session.query(
+                PositionRecord.id, PositionRecord.total_equity,
+                PositionRecord.total_long_value, PositionRecord.total_short_value,
+                PositionRecord.long_percentage, PositionRecord.short_percentage,
+                sums.c.long_value, sums.c.short_value, sums.c.total_pnl
+            )
+            .join(sums, sums.c.record_id == PositionRecord.id)
+            .order_by(PositionRecord.id)
+            .all()
+        )
+        if not records:
+            break
+        totals = _exposure_totals(
+            np.array([r.long_value or 0.0 for r in records]),
+            np.array([r.short_value or 0.0 for r in records]),
+            np.array([r.total_pnl or 0.0 for r in records]),
+            np.array([float(_parse_equity(r.total_equity)) for r in records])
+        )
+
+        rows = []
+        for i, record in enumerate(records):
+            row = {'id': record.id, **{name: _format_amount(values[i]) for name, values in totals.items()}}
+            if row['total_long_value'] == record.total_long_value:
+                row['long_percentage'] = record.long_percentage
+            if row['total_short_value'] == record.total_short_value:
+                row['short_percentage'] = record.short_percentage
+            rows.append(row)
+        db.session.execute(update(PositionRecord), rows)
+        bump_history_generation()
+        db.session.commit()
+        updated += len(rows)
+        last_id = records[-1].id
+    return updated
+
+
+@app.cli.command('recompute-summaries')
+def recompute_summaries_command():
+    """Přepočítá souhrny expozice a PnL celé historie z position_item."""
+    updated = recompute_history_summaries()
+    print(f"Přepočítáno {updated} záznamů.")
+
+
+# --- Retence a kompakce historie ---
+# Starší snapshoty se řídnou podle úrovní retence: v každém úseku (hodina, den,
+# týden) zůstanou jen vybrané záznamy. Agregace equity_rollup se nemažou, OHLC
+# a průměry za úseky tak zůstávají přesné i po kompakci. Hranici proředění si
+# kompakce ukládá (compacted_until), aby rebuild_rollups starší úseky nepřepsal
+# hodnotami z ponechaných záznamů.
+RETENTION_KEEP_OPTIONS = ('first', 'last', 'extremes')
+
+
+def parse_retention_tiers(value: str) -> List[RetentionTier]:
+    """
+    Načte úrovně ze zápisu "7:1h:last,90:1d:first+last+extremes"
+    (stáří ve dnech : rozlišení : ponechané snapshoty).
+    """
+    tiers = []
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        after_days, resolution, *keep = part.strip().split(':')
+        tier = RetentionTier(int(after_days), resolution, tuple(keep[0].split('+')) if keep else ('last',))
+        if tier.resolution not in ROLLUP_RESOLUTIONS:
+            raise ValueError(f"Neznámé rozlišení '{tier.resolution}' v úrovni retence.")
+        if not tier.keep or set(tier.keep) - set(RETENTION_KEEP_OPTIONS):
+            raise ValueError(f"Neplatné ponechané snapshoty {tier.keep}, povolené jsou {RETENTION_KEEP_OPTIONS}.")
+        tiers.append(tier)
+    return sorted(tiers, key=lambda tier: tier.after_days)
+
+
+def _records_to_drop(rows, resolution: str, keep: Tuple[str, ...]) -> List[int]:
+    # rows = (id, timestamp, equity) seřazené podle času; vrací id záznamů k odstranění
+    drop = []
+    bucket, members = None, []
+
+    def close_bucket():
+        if len(members) < 2:
+            return
+        kept = set()
+        if 'first' in keep:
+            kept.add(members[0][0])
+        if 'last' in keep:
+            kept.add(members[-1][0])
+        if 'extremes' in keep:
+            kept.add(min(members, key=lambda row: row[2])[0])
+            kept.add(max(members, key=lambda row: row[2])[0])
+        drop.extend(row[0] for row in members if row[0] not in kept)
+
+    for record_id, timestamp, equity in rows:
+        start = rollup_bucket_start(timestamp, resolution)
+        if start != bucket:
+            close_bucket()
+            bucket, members = start, []
+        members.append((record_id, timestamp, float(_parse_equity(equity))))
+    close_bucket()
+    return drop
+
+
+def _delete_records(record_ids: List[int]) -> int:
+    """
+    Smaže záznamy v jedné transakci. Delty, jejichž keyframe se maže, se převedou:
+    první z nich se stane keyframem a ostatní se zakódují vůči ní.
+    Vrací počet přepsaných záznamů.
+    """
+    orphans = (
+        db.session.query(PositionRecord.id, PositionRecord.keyframe_id, PositionRecord.positions_blob)
+        .filter(PositionRecord.keyframe_id.in_(record_ids), PositionRecord.id.notin_(record_ids))
+        .order_by(PositionRecord.id)
+        .all()
+    )
+    rewritten = []
+    keyframes = {} # původní keyframe -> (nový keyframe, jeho pozice, počet delt)
+    for record_id, keyframe_id, blob in orphans:
+        positions = decode_snapshot(blob, list(_load_keyframe(keyframe_id)))
+        keyframe = keyframes.get(keyframe_id)
+        new_blob, new_keyframe_id = _encode_positions(positions, keyframe)
+        if new_keyframe_id is None:
+            keyframes[keyframe_id] = (record_id, positions, 0)
+        else:
+            keyframes[keyframe_id] = (keyframe[0], keyframe[1], keyframe[2] + 1)
+        rewritten.append({'id': record_id, 'positions_blob': new_blob, 'keyframe_id': new_keyframe_id})
+
+    if rewritten:
+        db.session.execute(update(PositionRecord), rewritten)
+    db.session.query(PositionItem).filter(PositionItem.record_id.in_(record_ids)).delete(synchronize_session=False)
+    db.session.query(PositionRecord).filter(PositionRecord.id.in_(record_ids)).delete(synchronize_session=False)
+    bump_history_generation()
+    db.session.commit()
+    return len(rewritten)
+
+
+def _incremental_vacuum(pages_per_step: int) -> int:
+    """
+    Vrátí volné stránky souboru po malých krocích (každý krok je samostatná
+    krátká transakce). Vrací počet uvolněných bajtů.
+    """
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if connection.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+            logging.warning("Kompakce: Databáze nemá auto_vacuum=INCREMENTAL, místo se uvolní až po VACUUM (migrate-db).")
+            return 0
+        page_size = connection.execute(text('PRAGMA page_size')).scalar()
+        pages_before = connection.execute(text('PRAGMA page_count')).scalar()
+        while connection.execute(text('PRAGMA freelist_count')).scalar() > 0:
+            connection.execute(text(f'PRAGMA incremental_vacuum({int(pages_per_step)})'))
+        return (pages_before - connection.execute(text('PRAGMA page_count')).scalar()) * page_size
+
+
+def compact_history(tiers: Optional[List[RetentionTier]] = None, now: Optional[datetime] = None,
+                    batch_size: Optional[int] = None, vacuum: bool = True) -> Dict:
+    """
+    Proředí position_record podle úrovní retence a vrátí volné místo souboru DB.
+    Maže se po dávkách v krátkých transakcích, aby zápis snapshotů nečekal.
+    Vrací {'deleted', 'rewritten', 'bytes_reclaimed'}.
+    """
+    tiers = tiers if tiers is not None else config.retention_tiers
+    now = now or datetime.utcnow()
+    batch_size = batch_size or config.retention_batch_size
+    series = db.session.query(PositionRecord.account, PositionRecord.settlement_currency).distinct().all()
+    # Nejnovější keyframe řady může právě používat write-behind zápis
+    protected = {keyframe[0] for keyframe in (_latest_keyframe(*key) for key in series) if keyframe}
+
+    # Hranice se zarovnají na začátek úseku, aby se neproředily neúplné úseky;
+    # úroveň končí tam, kde začíná následující (hrubší) úroveň
+    bounds = [rollup_bucket_start(now - timedelta(days=tier.after_days), tier.resolution) for tier in tiers]
+    deleted = rewritten = 0
+    for index, tier in enumerate(tiers):
+        until = bounds[index]
+        since = bounds[index + 1] if index + 1 < len(tiers) else None
+        for account, settlement_currency in series:
+            query = db.session.query(PositionRecord.id, PositionRecord.timestamp, PositionRecord.total_equity).filter(
+                PositionRecord.account == account,
+                PositionRecord.settlement_currency == settlement_currency,
+                PositionRecord.timestamp < until
+            )
+            if since is not None:
+                query = query.filter(PositionRecord.timestamp >= since)
+            rows = query.order_by(PositionRecord.timestamp, PositionRecord.id).all()
+            drop = [record_id for record_id in _records_to_drop(rows, tier.resolution, tier.keep) if record_id not in protected]
+            for start in range(0, len(drop), batch_size):
+                chunk = drop[start:start + batch_size]
+                rewritten += _delete_records(chunk)
+                deleted += len(chunk)
+    _load_keyframe.cache_clear()
+    if deleted:
+        previous = get_setting(COMPACTED_UNTIL_SETTING)
+        if previous is None or datetime.fromisoformat(previous) < bounds[0]:
+            set_setting(COMPACTED_UNTIL_SETTING, bounds[0].isoformat())
+    items_deleted = prune_position_items(position_items_cutoff(now), batch_size * 100)
+
+    reclaimed = _incremental_vacuum(config.retention_vacuum_pages) if vacuum and (deleted or items_deleted) else 0
+    retention_records_deleted.inc(deleted)
+    retention_bytes_reclaimed.inc(reclaimed)
+    logging.info(f"Kompakce: Odstraněno {deleted} záznamů a {items_deleted} řádků position_item, "
+                 f"přepsáno {rewritten} delt, uvolněno {reclaimed} bajtů.")
+    return {'deleted': deleted, 'items_deleted': items_deleted, 'rewritten': rewritten, 'bytes_reclaimed': reclaimed}
+
+
+def prune_position_items(cutoff: datetime, batch_size: int) -> int:
+    """
+    Smaže řádky position_item snapshotů starších než `cutoff` (po dávkách).
+    Vrací počet smazaných řádků.
+    """
+    if cutoff == datetime.max:
+        # position_items_days=0: tabulka se už neplní, dřívější řádky se smažou všechny
+        cutoff = datetime.utcnow() + timedelta(days=1)
+    old_records = db.session.query(PositionRecord.id).filter(PositionRecord.timestamp < cutoff)
+    deleted = 0
+    while True:
+        chunk = db.session.query(PositionItem.id).filter(PositionItem.record_id.in_(old_records)).limit(batch_size)
+        count = db.session.query(PositionItem).filter(PositionItem.id.in_(chunk)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+@app.cli.command('compact-history')
+@click.option('--no-vacuum', is_flag=True, help="Jen smazat záznamy, soubor DB nezmenšovat.")
+def compact_history_command(no_vacuum):
+    """Proředí starou historii snapshotů podle úrovní retence."""
+    result = compact_history(vacuum=not no_vacuum)
+    print(f"Odstraněno {result['deleted']} záznamů a {result['items_deleted']} řádků position_item, "
+          f"přepsáno {result['rewritten']} delt, uvolněno {result['bytes_reclaimed']} bajtů.")
+
+
+# --- Write-behind ukládání snapshotů ---
+class WriteBehindQueue:
+    """
+    Snapshoty se zařadí do fronty a jediné vlákno je zapisuje po dávkách
+    v jedné transakci. Při plné frontě se zapisuje synchronně, při ukončení
+    procesu se fronta dopíše (atexit).
+    """
+    _STOP = object()
+
+    def __init__(self, app: Flask, max_size: int, batch_size: int, flush_interval: float):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self.written = 0
+        self.failed = 0
+        self.synchronous_writes = 0
+
+    def submit(self, summary: Dict, positions: List[Dict], account: str = DEFAULT_ACCOUNT) -> bool:
+        """
+        Vrací True, pokud byl snapshot zařazen do fronty, False při synchronním zápisu.
+        """
+        item = (summary, positions, datetime.utcnow(), account)
+        if self._ensure_started():
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except queue.Full:
+                logging.warning("Fronta zápisu je plná, ukládám snapshot synchronně.")
+        self._write([item])
+        with self._lock:
+            self.synchronous_writes += 1
+        return False
+
+    def flush(self):
+        self._queue.join()
+
+    def stop(self, timeout: float = 30.0):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(self._STOP)
+            thread.join(timeout)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_started(self) -> bool:
+        with self._lock:
+            if self._stopped:
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+            return True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is self._STOP
+            items = batch[:-1] if stop else batch
+            try:
+                if items:
+                    self._write(items)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, items: List[Tuple[Dict, List[Dict], datetime, str]]):
+        with self.app.app_context():
+            started = time.perf_counter()
+            try:
+                for summary, positions, timestamp, account in items:
+                    db.session.add(build_position_record(summary, positions, timestamp, account))
+                update_rollups([(timestamp, summary, account) for summary, _, timestamp, account in items])
+                db.session.commit()
+                db_write_seconds.observe(time.perf_counter() - started)
+                db_records_written.inc(len(items))
+                with self._lock:
+                    self.written += len(items)
+                return
+            except Exception as e:
+                db.session.rollback()
+                db_write_seconds.observe(time.perf_counter() - started)
+                if len(items) == 1:
+                    db_write_errors.inc()
+                    with self._lock:
+                        self.failed += 1
+                    logging.error(f"Chyba při ukládání historie pozic do databáze: {e}")
+                    return
+                logging.warning(f"Dávkový zápis selhal ({e}), zkouším záznamy jednotlivě.")
+        for item in items:
+            self._write([item])
+
+
 # Inicializace BybitTrader
-config = TradingConfig(testnet=False)
+config = TradingConfig(
+    testnet=False,
+    ws_url=os.getenv('BYBIT_WS_URL'),
+    rest_url=os.getenv('BYBIT_REST_URL'),
+    settle_coins=[coin.strip() for coin in os.getenv('BYBIT_SETTLE_COINS', 'USDT').split(',') if coin.strip()],
+    manual_snapshot_save=os.getenv('MANUAL_SNAPSHOT_SAVE', '0') == '1',
+    collector_metrics_port=int(os.getenv('COLLECTOR_METRICS_PORT', '9101')),
+    position_items_days=int(os.getenv('POSITION_ITEMS_DAYS', '7'))
+)
+if os.getenv('RETENTION_TIERS') is not None:
+    config.retention_tiers = parse_retention_tiers(os.getenv('RETENTION_TIERS'))
 try:
     trader = BybitTrader(config)
 except ValueError as e:
     logging.critical(f"Aplikace nemůže být spuštěna: {e}")
     trader = None
 
+
+def load_sub_account_traders(config: TradingConfig) -> Dict[str, BybitTrader]:
+    """
+    Další účty pro kolektor: BYBIT_ACCOUNTS=sub1,sub2 a klíče
+    BYBIT_API_KEY_SUB1/BYBIT_API_SECRET_SUB1 atd.
+    """
+    load_dotenv()
+    traders = {}
+    for name in (n.strip() for n in os.getenv('BYBIT_ACCOUNTS', '').split(',')):
+        if not name or name == DEFAULT_ACCOUNT:
+            continue
+        try:
+            traders[name] = BybitTrader(
+                config,
+                account=name,
+                api_key=os.getenv(f'BYBIT_API_KEY_{name.upper()}'),
+                api_secret=os.getenv(f'BYBIT_API_SECRET_{name.upper()}')
+            )
+        except ValueError as e:
+            logging.error(f"Účet {name} nelze inicializovat: {e}")
+    return traders
+
+
+account_traders = {DEFAULT_ACCOUNT: trader} if trader else {}
+account_traders.update(load_sub_account_traders(config))
+
+# Každá řada (účet × settle coin) drží v cache svůj aktuální keyframe a několik
+# starších pro čtení historie, jinak by se řady při zápisu navzájem vytlačovaly
+_load_keyframe = functools.lru_cache(
+    maxsize=max(32, KEYFRAMES_PER_SERIES * max(1, len(account_traders)) * len(config.settle_coins))
+)(_read_keyframe)
+
+# Kniha hlavního účtu slouží zároveň pro živý stream (SSE)
+position_book = trader.book if trader else PositionBook()
+
+write_queue = WriteBehindQueue(
+    app,
+    max_size=config.write_queue_size,
+    batch_size=config.write_batch_size,
+    flush_interval=config.write_flush_interval_seconds
+)
+atexit.register(write_queue.stop) # Dopsání fronty při ukončení procesu
+live_stream = LiveStateStream(trader, position_book, url=config.ws_url) if trader else None
+
+
+def start_live_stream() -> bool:
+    """
+    Spustí WebSocket stream pro /stream (SSE) v tomto procesu; opakované volání nic nedělá.
+    Vývojový server ho volá sám. Pod gunicornem se volá z hooku v gunicorn.conf.py:
+
+        def post_worker_init(worker):
+            import app_gemini
+            app_gemini.start_live_stream()
+
+    Každé otevřené SSE spojení drží vlákno workeru po celou dobu, proto je potřeba
+    worker s vlákny nebo greenlety (např. `gunicorn -k gthread --threads 32`
+    nebo `-k gevent`); se synchronními workery by každá otevřená záložka
+    blokovala celý worker. Bez spuštěného streamu vrací /stream 503
+    a dashboard ho neotevírá.
+    """
+    if not live_stream or not config.live_stream_enabled:
+        return False
+    if live_stream.running:
+        return True
+    try:
+        live_stream.start()
+    except Exception as e:
+        # Bez WebSocketu dashboard dál funguje přes REST
+        logging.error(f"Nepodařilo se spustit živý stream pozic: {e}")
+    return live_stream.running
+
+# --- Pořízení snapshotu účtu ---
+@dataclass
+class AccountSnapshot:
+    positions: List[Dict]
+    balance: Dict
+    settlement_currency: str = "USDT"
+    stale: bool = False # True, pokud část dat pochází z předchozího snapshotu
+
+snapshot_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='snapshot')
+_last_snapshot_parts = {} # (účet, část) -> poslední úspěšně načtené pozice/zůstatek pro případ timeoutu
+_last_snapshot_lock = threading.Lock()
+
+def start_snapshot(client: BybitTrader, settle_coins: List[str], executor: Optional[ThreadPoolExecutor] = None) -> Dict:
+    """
+    Zahájí souběžné načtení zůstatku účtu a pozic pro každý settle coin.
+    Volání jdou přes cache klienta, souběžné požadavky na stejná data se sloučí.
+    """
+    executor = executor or snapshot_executor
+    futures = {('positions', coin): executor.submit(client.get_open_positions, coin) for coin in settle_coins}
+    futures['balance'] = executor.submit(client.get_account_balance)
+    return futures
+
+
+def finish_snapshot(client: BybitTrader, futures: Dict, settlement_currency: str, timeout: float) -> AccountSnapshot:
+    """
+    Sestaví snapshot z výsledků start_snapshot (volající už počkal do společného
+    termínu). Pokud některé volání selhalo nebo nestihlo termín, použije se
+    poslední úspěšná hodnota účtu a snapshot se označí jako stale.
+    Bez předchozí hodnoty se chyba propaguje.
+    """
+    parts = {}
+    stale = False
+    for key in (('positions', settlement_currency), 'balance'):
+        future = futures[key]
+        if future.done() and future.exception() is None:
+            parts[key] = future.result()
+            with _last_snapshot_lock:
+                _last_snapshot_parts[(client.account, key)] = parts[key]
+            continue
+
+        error = future.exception() if future.done() else TimeoutError(f"Načtení '{key}' nestihlo limit {timeout} s.")
+        with _last_snapshot_lock:
+            fallback = copy.deepcopy(_last_snapshot_parts.get((client.account, key)))
+        if fallback is None:
+            raise error
+        logging.warning(f"Snapshot {client.account}: {error} Používám předchozí data.")
+        parts[key] = fallback
+        stale = True
+
+    snapshot = AccountSnapshot(
+        positions=parts[('positions', settlement_currency)],
+        balance=parts['balance'],
+        settlement_currency=settlement_currency,
+        stale=stale
+    )
+    if not stale and client is trader:
+        reconcile_position_book(snapshot)
+    return snapshot
+
+
+def acquire_snapshot(settlement_currency: str = "USDT", timeout: Optional[float] = None,
+                     client: Optional[BybitTrader] = None) -> AccountSnapshot:
+    """
+    Načte pozice a zůstatek účtu (výchozí je hlavní) souběžně, viz finish_snapshot.
+    """
+    client = client or trader
+    timeout = config.snapshot_timeout_seconds if timeout is None else timeout
+    futures = start_snapshot(client, [settlement_currency])
+    wait(futures.values(), timeout=timeout)
+    return finish_snapshot(client, futures, settlement_currency, timeout)
+
+
+def reconcile_position_book(snapshot: AccountSnapshot):
+    # Pozice do knihy promítá už BybitTrader při načtení, zbývá zůstatek
+    position_book.update_wallet(snapshot.balance)
+
+
+class SnapshotCollector:
+    """
+    Pořídí snapshoty všech účtů a settle coinů najednou stejnou cestou jako
+    acquire_snapshot (cache klienta, fallback na poslední data účtu). Zůstatek
+    každého účtu i pozice každé dvojice (účet, settle coin) se načítají souběžně
+    v omezeném poolu vláken se společným termínem; počet požadavků na účet
+    hlídá jeho TokenBucket.
+    """
+    def __init__(self, traders: Dict[str, BybitTrader], settle_coins: List[str], max_workers: int):
+        self.traders = traders
+        self.settle_coins = settle_coins
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='collector')
+
+    def collect(self, timeout: Optional[float] = None) -> Tuple[List[Tuple[str, AccountSnapshot]], Dict[str, Exception]]:
+        """
+        Vrací (seznam (účet, snapshot), chyby podle "účet/coin").
+        """
+        timeout = config.snapshot_timeout_seconds if timeout is None else timeout
+        started = {
+            account: start_snapshot(client, self.settle_coins, self._executor)
+            for account, client in self.traders.items()
+        }
+        wait([future for futures in started.values() for future in futures.values()], timeout=timeout)
+
+        snapshots, errors = [], {}
+        for account, futures in started.items():
+            for coin in self.settle_coins:
+                try:
+                    snapshots.append((account, finish_snapshot(self.traders[account], futures, coin, timeout)))
+                except Exception as e:
+                    errors[f"{account}/{coin}"] = e
+        return snapshots, errors
+
+
+collector = SnapshotCollector(account_traders, config.settle_coins, config.collector_max_workers)
+
 # --- Funkce pro plánovanou úlohu ---
 def scheduled_position_save():
     """
     Tato funkce se bude spouštět plánovačem a ukládat aktuální pozice do DB.
     """
-    if not trader:
+    job = 'scheduled_position_save'
+    if not account_traders:
         logging.error("Scheduler: Trading client není inicializován, přeskočeno ukládání pozic.")
+        scheduler_job_errors.inc(job=job)
         return
 
+    started = time.perf_counter()
     with app.app_context(): # Důležité pro přístup k databázi ve Flask kontextu
         try:
-            positions = trader.get_open_positions()
-            settlement_currency = "USDT"
+            snapshots, errors = collector.collect()
+            for name, error in errors.items():
+                logging.error(f"Scheduler: Snapshot {name} se nepodařilo načíst: {error}")
+                scheduler_job_errors.inc(job=job)
+
+            # Zastaralá (fallback) data se do historie neukládají, stejně jako u /positions
+            for account, snapshot in snapshots:
+                if snapshot.stale:
+                    logging.warning(f"Scheduler: Snapshot {account}/{snapshot.settlement_currency} je zastaralý, neukládá se.")
+                    scheduler_job_errors.inc(job=job)
+            fresh = [(account, snapshot) for account, snapshot in snapshots if not snapshot.stale]
+            for account, snapshot in fresh:
+                summary = summarize_positions(snapshot.positions, snapshot.balance, snapshot.settlement_currency)
+                write_queue.submit(summary, snapshot.positions, account)
+            logging.info(f"Scheduler: {len(fresh)} snapshotů zařazeno k uložení do databáze v {datetime.now()}.")
+            if fresh:
+                scheduler_last_success.set(time.time(), job=job)
+        except Exception as e:
+            logging.error(f"Scheduler: Chyba při ukládání historie pozic do databáze: {e}")
+            scheduler_job_errors.inc(job=job)
+        finally:
+            scheduler_job_seconds.observe(time.perf_counter() - started, job=job)
+
+
+def scheduled_history_compaction():
+    """
+    Naplánovaná kompakce staré historie podle úrovní retence a promazání
+    position_item mimo okno position_items_days.
+    """
+    job = 'scheduled_history_compaction'
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            compact_history(tiers=None if config.retention_enabled else [])
+            scheduler_last_success.set(time.time(), job=job)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Scheduler: Chyba při kompakci historie: {e}")
+            scheduler_job_errors.inc(job=job)
+        finally:
+            scheduler_job_seconds.observe(time.perf_counter() - started, job=job)
 
-            total_long_value = Decimal('0')
-            total_short_value = Decimal('0')
-            total_pnl = Decimal('0')
-            long_symbols = []
-            short_symbols = []
-            long_positions_detailed = []
-            short_positions_detailed = []
 
-            balance_info = trader.get_account_balance()
-            total_equity_str = balance_info.get('total_equity', '0')
-            total_equity = Decimal(total_equity_str if total_equity_str != 'N/A' else '0')
+def _on_scheduler_event(event):
+    # Zpoždění a vynechaná spuštění úloh plánovače
+    if event.code == EVENT_JOB_SUBMITTED:
+        for run_time in event.scheduled_run_times:
+            scheduler_job_lag_seconds.observe(
+                max((datetime.now(run_time.tzinfo) - run_time).total_seconds(), 0.0), job=event.job_id)
+    elif event.code == EVENT_JOB_MISSED:
+        scheduler_missed_runs.inc(job=event.job_id, reason='misfire')
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        scheduler_missed_runs.inc(job=event.job_id, reason='max_instances')
 
-            for pos in positions:
-                position_value = Decimal(str(abs(float(pos['positionValue']))))
-                unrealized_pnl = Decimal(str(pos['unrealized_pnl']))
-                total_pnl += unrealized_pnl
-
-                if pos['side'] == 'Buy':
-                    total_long_value += position_value
-                    long_symbols.append(pos['symbol'].replace('USDT', ''))
-                    long_positions_detailed.append(pos)
-                else:
-                    total_short_value += position_value
-                    short_symbols.append(pos['symbol'].replace('USDT', ''))
-                    short_positions_detailed.append(pos)
-
-            long_percentage = (total_long_value / total_equity) * 100 if total_equity > 0 else Decimal('0.00')
-            short_percentage = (total_short_value / total_equity) * 100 if total_equity > 0 else Decimal('0.00')
-
-            summary = {
-                'total_long_value': f"{total_long_value:.2f}",
-                'total_short_value': f"{total_short_value:.2f}",
-                'long_percentage': f"{long_percentage:.2f}",
-                'short_percentage': f"{short_percentage:.2f}",
-                'long_symbols': ','.join(long_symbols),
-                'short_symbols': ','.join(short_symbols),
-                'settlement_currency': settlement_currency,
-                'total_pnl': f"{total_pnl:.2f}",
-                'total_equity': f"{total_equity:.2f}"
-            }
 
-            new_record = PositionRecord(
-                total_equity=summary['total_equity'],
-                total_long_value=summary['total_long_value'],
-                total_short_value=summary['total_short_value'],
-                long_percentage=summary['long_percentage'],
-                short_percentage=summary['short_percentage'],
-                long_symbols=summary['long_symbols'],
-                short_symbols=summary['short_symbols'],
-                settlement_currency=summary['settlement_currency'],
-                total_pnl=summary['total_pnl'],
-                positions_json=json.dumps(positions)
-            )
-            db.session.add(new_record)
+# --- Samostatný kolektor (leader lease a sdílené nastavení v DB) ---
+# Webové workery (např. gunicorn) plánovač nespouštějí. Snapshoty pořizuje proces
+# `flask --app app_gemini run-collector`; z více spuštěných kolektorů pracuje jen
+# držitel lease v tabulce collector_lease, ostatní čekají v záloze. Interval
+# plánovače se předává přes tabulku app_setting.
+COLLECTOR_LEASE_NAME = 'collector'
+SCHEDULER_INTERVAL_SETTING = 'scheduler_interval_minutes'
+# Zvyšuje se při každé změně historie, kterou nové id neodhalí (mazání, přepočet, backfill)
+HISTORY_GENERATION_SETTING = 'history_generation'
+# Nejnovější hranice, po kterou kompakce proředila historii (ISO 8601, UTC)
+COMPACTED_UNTIL_SETTING = 'compacted_until'
+
+
+class CollectorLease(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class AppSetting(db.Model):
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.String(200), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    value = db.session.query(AppSetting.value).filter(AppSetting.key == key).scalar()
+    return default if value is None else value
+
+
+def set_setting(key: str, value: str):
+    now = datetime.utcnow()
+    db.session.execute(sqlite_insert(AppSetting).values(key=key, value=value, updated_at=now).on_conflict_do_update(
+        index_elements=['key'], set_={'value': value, 'updated_at': now}
+    ))
+    db.session.commit()
+
+
+def bump_history_generation():
+    # Bez commitu: zvýšení se potvrdí ve stejné transakci jako změna historie
+    now = datetime.utcnow()
+    db.session.execute(sqlite_insert(AppSetting).values(key=HISTORY_GENERATION_SETTING, value='1', updated_at=now).on_conflict_do_update(
+        index_elements=['key'],
+        set_={'value': cast(cast(AppSetting.value, db.Integer) + 1, db.String), 'updated_at': now}
+    ))
+
+
+class LeaderLease:
+    """
+    Lease v DB s omezenou platností: držitel ho obnovuje, po vypršení ho
+    převezme jiný kolektor. Lokálně se považuje za platný jen do doby
+    (obnova + ttl) podle monotónních hodin, aby po výpadku DB nepracovali dva.
+    """
+    def __init__(self, name: str, ttl_seconds: float):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._held_until = 0.0
+
+    def held(self) -> bool:
+        return time.monotonic() < self._held_until
+
+    def acquire(self) -> bool:
+        """
+        Získá nebo obnoví lease; vrací True, pokud ho tento proces drží.
+        """
+        started = time.monotonic()
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.ttl_seconds)
+        with app.app_context():
+            try:
+                db.session.execute(
+                    sqlite_insert(CollectorLease).values(name=self.name, owner=self.owner, expires_at=expires_at)
+                    .on_conflict_do_update(
+                        index_elements=['name'],
+                        set_={'owner': self.owner, 'expires_at': expires_at},
+                        where=or_(CollectorLease.owner == self.owner, CollectorLease.expires_at < now)
+                    )
+                )
+                db.session.commit()
+                holder = db.session.query(CollectorLease.owner).filter(CollectorLease.name == self.name).scalar()
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Kolektor: Lease nelze obnovit: {e}")
+                return self.held()
+        self._held_until = started + self.ttl_seconds if holder == self.owner else 0.0
+        return self.held()
+
+    def release(self):
+        self._held_until = 0.0
+        with app.app_context():
+            db.session.query(CollectorLease).filter(
+                CollectorLease.name == self.name, CollectorLease.owner == self.owner
+            ).delete(synchronize_session=False)
             db.session.commit()
-            logging.info(f"Scheduler: Historie pozic úspěšně uložena do databáze v {datetime.now()}.")
-        except Exception as db_e:
-            db.session.rollback()
-            logging.error(f"Scheduler: Chyba při ukládání historie pozic do databáze: {db_e}")
 
-# Routes (beze změny, jen pro úplnost)
+
+collector_lease: Optional[LeaderLease] = None # nastaví start_collector()
+
+
+def run_if_leader(func):
+    # Naplánovaná úloha se provede jen v kolektoru, který drží lease
+    @functools.wraps(func)
+    def wrapper():
+        if collector_lease is not None and not collector_lease.held():
+            return
+        return func()
+    return wrapper
+
+
+def _schedule_position_save(minutes: int):
+    scheduler.add_job(
+        id='scheduled_position_save_job',
+        func=run_if_leader(scheduled_position_save),
+        trigger='interval',
+        minutes=minutes,
+        max_instances=1, # Zabrání souběžnému spuštění více instancí úlohy
+        replace_existing=True
+    )
+
+
+def collector_heartbeat():
+    """
+    Obnoví lease a převezme změnu intervalu zapsanou webem do app_setting.
+    """
+    was_leader = collector_lease.held()
+    is_leader = collector_lease.acquire()
+    if is_leader != was_leader:
+        logging.info(f"Kolektor: {'Převzat' if is_leader else 'Ztracen'} lease ({collector_lease.owner}).")
+    with app.app_context():
+        try:
+            interval = int(get_setting(SCHEDULER_INTERVAL_SETTING, config.scheduler_interval_minutes))
+        except Exception as e:
+            logging.error(f"Kolektor: Nastavení intervalu nelze načíst: {e}")
+            return
+    if interval != config.scheduler_interval_minutes:
+        config.scheduler_interval_minutes = interval
+        _schedule_position_save(interval)
+        logging.info(f"Kolektor: Interval plánovače změněn na {interval} minut.")
+
+
+def start_collector():
+    """
+    Spustí plánovač s úlohami kolektoru. Úlohy běží jen v procesu, který drží lease.
+    """
+    global collector_lease
+    collector_lease = LeaderLease(COLLECTOR_LEASE_NAME, config.collector_lease_seconds)
+    with app.app_context():
+        config.scheduler_interval_minutes = int(get_setting(SCHEDULER_INTERVAL_SETTING, config.scheduler_interval_minutes))
+    collector_lease.acquire()
+    logging.info(f"Kolektor: {'Držím' if collector_lease.held() else 'Čekám na'} lease ({collector_lease.owner}).")
+
+    scheduler.init_app(app)
+    scheduler.add_listener(_on_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+    scheduler.add_job(
+        id='collector_heartbeat_job',
+        func=collector_heartbeat,
+        trigger='interval',
+        seconds=config.collector_lease_seconds / 3,
+        max_instances=1
+    )
+    _schedule_position_save(config.scheduler_interval_minutes)
+    if config.retention_enabled or config.position_items_days > 0:
+        scheduler.add_job(
+            id='scheduled_history_compaction_job',
+            func=run_if_leader(scheduled_history_compaction),
+            trigger='interval',
+            hours=config.retention_interval_hours,
+            max_instances=1
+        )
+    scheduler.start()
+    atexit.register(collector_lease.release)
+    logging.info(f"Plánovač spuštěn s intervalem {config.scheduler_interval_minutes} minut.")
+
+
+# Odvozené metriky čtené při scrapu
+metrics.callback('cache_requests_total', "Požadavky na cache odpovědí API podle výsledku.", 'counter', lambda: [
+    ({'account': account, 'result': result}, client.cache.stats()[result])
+    for account, client in account_traders.items() for result in ('hits', 'misses', 'coalesced')
+])
+metrics.callback('write_queue_pending', "Snapshoty čekající ve write-behind frontě.", 'gauge',
+                 lambda: [({}, write_queue.pending())])
+metrics.callback('db_synchronous_writes_total', "Snapshoty zapsané synchronně kvůli plné frontě.", 'counter',
+                 lambda: [({}, write_queue.synchronous_writes)])
+metrics.callback('live_stream_subscribers', "Připojení klienti živého streamu (SSE).", 'gauge',
+                 lambda: [({}, position_book.subscriber_count())])
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        http_request_seconds.observe(
+            time.perf_counter() - started,
+            route=request.url_rule.rule if request.url_rule else 'unmatched',
+            method=request.method,
+            status=response.status_code
+        )
+    return response
+
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=METRICS_CONTENT_TYPE)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    # Minimální HTTP server pro /metrics procesu bez webového serveru (run-collector)
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapy by zahlcovaly log
+
+
+def serve_metrics(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Vystaví /metrics tohoto procesu na samostatném portu (vlákno na pozadí).
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+# --- Backfill historie z executions a closed PnL ---
+# Stažené záznamy se ukládají do vlastních tabulek (INSERT OR IGNORE podle ID
+# z burzy) ve stejné transakci jako kurzor stránkování, takže přerušený backfill
+# pokračuje tam, kde skončil, a neukládá duplicity. Z uložených obchodů se pak
+# přehráním zrekonstruují pozice a doplní se snapshoty do mezer v historii.
+BACKFILL_WINDOW = timedelta(days=7) # Bybit vrací nejvýše 7 dní na jeden dotaz
+BACKFILL_EPOCH = datetime(2020, 1, 6) # pevná mřížka oken, aby se checkpointy shodovaly mezi běhy
+BACKFILL_PAGE_LIMIT = 100
+BACKFILL_SOURCES = {'executions': 'get_executions', 'closed_pnl': 'get_closed_pnl'}
+# Typy executions podle dopadu na rekonstruovanou pozici: obchody (včetně ADL,
+# likvidace a doručení futures) mění velikost, Funding jen účtuje poplatek
+# a Settle (vypořádání USDC kontraktů) převede nerealizovaný PnL do peněženky
+# a posune vstupní cenu na cenu vypořádání. Ostatní typy se přeskočí.
+POSITION_EXEC_TYPES = {'Trade', 'AdlTrade', 'BustTrade', 'Delivery', 'BlockTrade', 'MovePosition', 'FutureSpread'}
+FUNDING_EXEC_TYPES = {'Funding'}
+SETTLE_EXEC_TYPES = {'Settle'}
+INSTRUMENTS_PAGE_LIMIT = 1000
+KLINE_INTERVALS = (1, 3, 5, 15, 30, 60, 120, 240, 360, 720)
+KLINE_LIMIT = 1000
+
+
+class BackfillCheckpoint(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('account', 'source', 'symbol', 'window_start', name='uq_backfill_checkpoint_task'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(50), nullable=False)
+    source = db.Column(db.String(20), nullable=False)
+    symbol = db.Column(db.String(50), nullable=False, default='') # '' = všechny symboly
+    window_start = db.Column(db.DateTime, nullable=False)
+    window_end = db.Column(db.DateTime, nullable=False)
+    cursor = db.Column(db.String(500))
+    completed = db.Column(db.Boolean, nullable=False, default=False)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+
+
+class BackfillExecution(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('account', 'exec_id', name='uq_backfill_execution_exec_id'),
+        db.Index('ix_backfill_execution_account_time', 'account', 'exec_time'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(50), nullable=False)
+    exec_id = db.Column(db.String(64), nullable=False)
+    symbol = db.Column(db.String(50), nullable=False)
+    side = db.Column(db.String(10), nullable=False)
+    exec_type = db.Column(db.String(20))
+    exec_qty = db.Column(db.String(50))
+    exec_price = db.Column(db.String(50))
+    exec_fee = db.Column(db.String(50))
+    exec_time = db.Column(db.DateTime, nullable=False)
+
+
+class BackfillClosedPnl(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('account', 'order_id', name='uq_backfill_closed_pnl_order'),
+        db.Index('ix_backfill_closed_pnl_account_time', 'account', 'updated_time'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(50), nullable=False)
+    order_id = db.Column(db.String(64), nullable=False)
+    symbol = db.Column(db.String(50), nullable=False)
+    closed_pnl = db.Column(db.String(50))
+    updated_time = db.Column(db.DateTime, nullable=False)
+
+
+def _to_ms(value: datetime) -> int:
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _from_ms(value) -> datetime:
+    return datetime.fromtimestamp(int(value) / 1000, timezone.utc).replace(tzinfo=None)
+
+
+def _backfill_windows(start: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+    window_start = BACKFILL_EPOCH + ((start - BACKFILL_EPOCH) // BACKFILL_WINDOW) * BACKFILL_WINDOW
+    windows = []
+    while window_start < end:
+        windows.append((window_start, min(window_start + BACKFILL_WINDOW, end)))
+        window_start += BACKFILL_WINDOW
+    return windows
+
+
+def _store_backfill_rows(account: str, source: str, rows: List[Dict]) -> int:
+    if source == 'executions':
+        model = BackfillExecution
+        values = [{
+            'account': account,
+            'exec_id': row['execId'],
+            'symbol': row['symbol'],
+            'side': row['side'],
+            'exec_type': row.get('execType') or 'Trade',
+            'exec_qty': row.get('execQty') or '0',
+            'exec_price': row.get('execPrice') or '0',
+            'exec_fee': row.get('execFee') or '0',
+            'exec_time': _from_ms(row['execTime'])
+        } for row in rows]
+    else:
+        model = BackfillClosedPnl
+        values = [{
+            'account': account,
+            'order_id': row['orderId'],
+            'symbol': row['symbol'],
+            'closed_pnl': row.get('closedPnl') or '0',
+            'updated_time': _from_ms(row.get('updatedTime') or row['createdTime'])
+        } for row in rows]
+    if not values:
+        return 0
+    return db.session.execute(sqlite_insert(model).values(values).on_conflict_do_nothing()).rowcount
+
+
+def _backfill_task(client: BybitTrader, source: str, symbol: str, window_start: datetime, window_end: datetime) -> int:
+    """
+    Stáhne všechny stránky jednoho okna. Po každé stránce se v jedné transakci
+    uloží řádky i kurzor; vrací počet nově uložených řádků.
+    """
+    with app.app_context():
+        db.session.execute(sqlite_insert(BackfillCheckpoint).values(
+            account=client.account, source=source, symbol=symbol, window_start=window_start,
+            window_end=window_end, completed=False, rows=0
+        ).on_conflict_do_nothing())
+        checkpoint = BackfillCheckpoint.query.filter_by(
+            account=client.account, source=source, symbol=symbol, window_start=window_start
+        ).one()
+        if checkpoint.completed and checkpoint.window_end >= window_end:
+            db.session.commit()
+            return 0
+        if checkpoint.completed:
+            # Okno končilo "teď" a od minula přibyla data: projde se znovu, duplicity se přeskočí
+            checkpoint.completed = False
+            checkpoint.cursor = None
+        checkpoint.window_end = window_end
+        db.session.commit()
+
+        stored = 0
+        while not checkpoint.completed:
+            params = {
+                'category': client.config.default_category,
+                'startTime': _to_ms(window_start),
+                'endTime': _to_ms(window_end),
+                'limit': BACKFILL_PAGE_LIMIT
+            }
+            if symbol:
+                params['symbol'] = symbol
+            if checkpoint.cursor:
+                params['cursor'] = checkpoint.cursor
+            result = client.dispatcher.call(BACKFILL_SOURCES[source], **params).get('result', {})
+            rows = result.get('list', [])
+            inserted = _store_backfill_rows(client.account, source, rows)
+            checkpoint.cursor = result.get('nextPageCursor') or None
+            checkpoint.completed = not rows or checkpoint.cursor is None
+            checkpoint.rows += inserted
+            db.session.commit()
+            stored += inserted
+        return stored
+
+
+def fetch_backfill_sources(client: BybitTrader, start: datetime, end: datetime,
+                           symbols: Optional[List[str]] = None, workers: Optional[int] = None) -> Tuple[Dict[str, int], List[str]]:
+    """
+    Souběžně stáhne executions a closed PnL po oknech (a případně symbolech).
+    Vrací (počet nově uložených řádků podle zdroje, chyby); nedokončená okna
+    pokračují při dalším spuštění od uloženého kurzoru.
+    """
+    tasks = [
+        (source, symbol or '', window_start, window_end)
+        for source in BACKFILL_SOURCES
+        for symbol in (symbols or [None])
+        for window_start, window_end in _backfill_windows(start, end)
+    ]
+    totals, errors = {source: 0 for source in BACKFILL_SOURCES}, []
+    with ThreadPoolExecutor(max_workers=workers or config.backfill_workers, thread_name_prefix='backfill') as executor:
+        futures = {executor.submit(_backfill_task, client, *task): task for task in tasks}
+    for future, (source, symbol, window_start, _) in futures.items():
+        try:
+            totals[source] += future.result()
+        except Exception as e:
+            errors.append(f"{source} {symbol or '*'} {window_start:%Y-%m-%d}: {e}")
+    return totals, errors
+
+
+def _kline_interval(step_minutes: int) -> int:
+    return max([interval for interval in KLINE_INTERVALS if interval <= step_minutes] or [KLINE_INTERVALS[0]])
+
+
+def fetch_mark_prices(client: BybitTrader, symbols: List[str], start: datetime, end: datetime,
+                      step_minutes: int, workers: Optional[int] = None) -> Dict[str, Tuple[List[int], List[float]]]:
+    """
+    Mark price svíčky pro ocenění rekonstruovaných pozic. Vrací
+    symbol -> (časy konců svíček v ms, zavírací ceny).
+    """
+    interval = _kline_interval(step_minutes)
+    span = timedelta(minutes=interval * KLINE_LIMIT)
+    tasks = []
+    for symbol in symbols:
+        window_start = start
+        while window_start < end:
+            tasks.append((symbol, window_start, min(window_start + span, end)))
+            window_start += span
+
+    def fetch(symbol: str, window_start: datetime, window_end: datetime):
+        result = client.dispatcher.call(
+            'get_mark_price_kline',
+            category=client.config.default_category,
+            symbol=symbol,
+            interval=str(interval),
+            start=_to_ms(window_start),
+            end=_to_ms(window_end),
+            limit=KLINE_LIMIT
+        ).get('result', {})
+        return [(int(candle[0]) + interval * 60000, float(candle[4])) for candle in result.get('list', [])]
+
+    candles = {symbol: {} for symbol in symbols}
+    with ThreadPoolExecutor(max_workers=workers or config.backfill_workers, thread_name_prefix='backfill-kline') as executor:
+        futures = {executor.submit(fetch, *task): task[0] for task in tasks}
+    for future, symbol in futures.items():
+        try:
+            candles[symbol].update(future.result())
+        except Exception as e:
+            logging.warning(f"Backfill: Mark price pro {symbol} nelze načíst ({e}), použije se cena obchodů.")
+    return {symbol: (sorted(values), [values[t] for t in sorted(values)]) for symbol, values in candles.items()}
+
+
+def fetch_settle_coins(client: BybitTrader) -> Dict[str, str]:
+    """
+    Vrátí symbol -> settle coin pro kontrakty kategorie klienta. USDC kontrakty
+    nemají v názvu měnu vypořádání (např. BTCPERP), suffix symbolu nestačí.
+    """
+    settle_coins, cursor = {}, None
+    while True:
+        params = {'category': client.config.default_category, 'limit': INSTRUMENTS_PAGE_LIMIT}
+        if cursor:
+            params['cursor'] = cursor
+        result = client.dispatcher.call('get_instruments_info', **params).get('result', {})
+        settle_coins.update({item['symbol']: item.get('settleCoin', '') for item in result.get('list', [])})
+        cursor = result.get('nextPageCursor') or None
+        if not cursor or not result.get('list'):
+            return settle_coins
+
+
+def _settle_coin(symbol: str, settle_coins: Dict[str, str]) -> str:
+    # Stažené (delistované) kontrakty v seznamu chybí; lineární kontrakty se vypořádávají v USDT nebo USDC
+    return settle_coins.get(symbol) or ('USDT' if symbol.endswith('USDT') else 'USDC')
+
+
+def reconstruct_snapshots(account: str, settlement_currency: str, start: datetime, end: datetime, step_minutes: int,
+                          current_positions: List[Dict], wallet_balance: Decimal,
+                          marks: Dict[str, Tuple[List[int], List[float]]],
+                          symbols: List[str]) -> List[Tuple[datetime, Dict, List[Dict]]]:
+    """
+    Přehraje uložené executions od `start` a vrátí (timestamp, souhrn, pozice)
+    pro body mřížky po `step_minutes`, ve kterých chybí uložený snapshot.
+    `symbols` jsou kontrakty vypořádávané v `settlement_currency`.
+
+    Výchozí stav se dopočítá zpětně z aktuálních pozic, zůstatek peněženky
+    z aktuálního zůstatku minus pozdější closed PnL a funding. Vklady, výběry
+    a poplatky otevřených pozic se nezapočítávají, equity je proto přibližná.
+    """
+    executions = (
+        db.session.query(BackfillExecution)
+        .filter(BackfillExecution.account == account, BackfillExecution.exec_time >= start,
+                BackfillExecution.symbol.in_(symbols))
+        .order_by(BackfillExecution.exec_time, BackfillExecution.id)
+        .all()
+    )
+    closed = (
+        db.session.query(BackfillClosedPnl.updated_time, BackfillClosedPnl.closed_pnl)
+        .filter(BackfillClosedPnl.account == account, BackfillClosedPnl.updated_time >= start,
+                BackfillClosedPnl.symbol.in_(symbols))
+        .order_by(BackfillClosedPnl.updated_time)
+        .all()
+    )
+
+    unknown = {ex.exec_type for ex in executions} - POSITION_EXEC_TYPES - FUNDING_EXEC_TYPES - SETTLE_EXEC_TYPES
+    if unknown:
+        logging.warning(f"Backfill: Neznámé typy executions {sorted(unknown)} se přeskočí.")
+    events = [ex for ex in executions if ex.exec_type in POSITION_EXEC_TYPES or ex.exec_type in SETTLE_EXEC_TYPES]
+    trades = [ex for ex in events if ex.exec_type in POSITION_EXEC_TYPES]
+    state = {} # symbol -> [podepsaná velikost, průměrná cena, createdTime, poslední cena]
+    for pos in current_positions:
+        size = Decimal(pos['size']) * (1 if pos['side'] == 'Buy' else -1)
+        state[pos['symbol']] = [size, Decimal(pos['avgPrice'] or 0), pos['createdTime'], Decimal(pos['avgPrice'] or 0)]
+    for ex in events:
+        entry = state.setdefault(ex.symbol, [Decimal(0), Decimal(ex.exec_price), '', Decimal(ex.exec_price)])
+        if ex.exec_type in POSITION_EXEC_TYPES:
+            entry[0] -= Decimal(ex.exec_qty) * (1 if ex.side == 'Buy' else -1) # zpětně: velikost před prvním obchodem v okně
+    for symbol, entry in state.items():
+        first_price = next((Decimal(ex.exec_price) for ex in trades if ex.symbol == symbol), entry[1])
+        if entry[1] == 0 or symbol not in {pos['symbol'] for pos in current_positions}:
+            entry[1] = first_price
+        entry[3] = first_price
+
+    def replay(entry: List, ex: BackfillExecution) -> Decimal:
+        # Promítne execution do stavu symbolu; vrací PnL převedený vypořádáním do peněženky
+        price = Decimal(ex.exec_price)
+        if ex.exec_type in SETTLE_EXEC_TYPES:
+            settled = (price - entry[1]) * entry[0]
+            entry[1] = entry[3] = price
+            return settled
+        qty = Decimal(ex.exec_qty) * (1 if ex.side == 'Buy' else -1)
+        if entry[0] == 0 or (entry[0] > 0) == (qty > 0):
+            total = abs(entry[0]) + abs(qty)
+            entry[1] = (abs(entry[0]) * entry[1] + abs(qty) * price) / total if total else price
+            if entry[0] == 0:
+                entry[2] = ex.exec_time.strftime('%Y-%m-%d %H:%M:%S')
+        elif abs(qty) > abs(entry[0]):
+            # Překlopení pozice na druhou stranu
+            entry[1], entry[2] = price, ex.exec_time.strftime('%Y-%m-%d %H:%M:%S')
+        entry[0] += qty
+        entry[3] = price
+        return Decimal(0)
+
+    # Vypořádaný PnL závisí na vstupní ceně v daném okamžiku, dopočítá se předběžným přehráním
+    preview = {symbol: list(entry) for symbol, entry in state.items()}
+    settlements = [(ex.exec_time, replay(preview[ex.symbol], ex)) for ex in events]
+
+    # Zůstatek v čase t = aktuální zůstatek + součet korekcí po t (-closed PnL, -vypořádání, +zaplacený funding)
+    wallet_events = [(row.updated_time, -Decimal(row.closed_pnl)) for row in closed]
+    wallet_events += [(exec_time, -settled) for exec_time, settled in settlements if settled]
+    wallet_events += [(ex.exec_time, Decimal(ex.exec_fee)) for ex in executions if ex.exec_type in FUNDING_EXEC_TYPES]
+    wallet_events.sort(key=lambda event: event[0])
+    wallet_times = [event[0] for event in wallet_events]
+    wallet_after = [Decimal(0)] * (len(wallet_events) + 1) # součet změn od indexu do konce
+    for index in range(len(wallet_events) - 1, -1, -1):
+        wallet_after[index] = wallet_after[index + 1] + wallet_events[index][1]
+
+    existing = {
+        round((timestamp - start).total_seconds() / (step_minutes * 60))
+        for (timestamp,) in db.session.query(PositionRecord.timestamp).filter(
+            PositionRecord.account == account, PositionRecord.settlement_currency == settlement_currency,
+            PositionRecord.timestamp >= start, PositionRecord.timestamp <= end
+        )
+    }
+
+    snapshots = []
+    event_index = 0
+    step = timedelta(minutes=step_minutes)
+    for index in range(int((end - start) / step) + 1):
+        moment = start + index * step
+        while event_index < len(events) and events[event_index].exec_time <= moment:
+            ex = events[event_index]
+            event_index += 1
+            replay(state[ex.symbol], ex)
+        if index in existing:
+            continue
+
+        moment_ms = _to_ms(moment)
+        positions, unrealized = [], Decimal(0)
+        for symbol, (size, avg_price, created, last_price) in state.items():
+            if size == 0:
+                continue
+            mark = last_price
+            times, closes = marks.get(symbol, ([], []))
+            candle = bisect.bisect_right(times, moment_ms) - 1
+            if candle >= 0:
+                mark = Decimal(str(closes[candle]))
+            pnl = (mark - avg_price) * size
+            unrealized += pnl
+            positions.append({
+                'symbol': symbol,
+                'size': str(abs(size)),
+                'positionValue': f"{abs(size) * mark:.4f}",
+                'side': 'Buy' if size > 0 else 'Sell',
+                'unrealized_pnl': f"{pnl:.4f}",
+                'avgPrice': f"{avg_price:.8f}".rstrip('0').rstrip('.'),
+                'createdTime': created
+            })
+        wallet = wallet_balance + wallet_after[bisect.bisect_right(wallet_times, moment)]
+        summary = summarize_positions(positions, {'total_equity': f"{wallet + unrealized:.2f}"}, settlement_currency)
+        snapshots.append((moment, summary, positions))
+    return snapshots
+
+
+def write_backfill_snapshots(account: str, snapshots: List[Tuple[datetime, Dict, List[Dict]]], chunk_size: int = 1000) -> int:
+    """
+    Hromadně zapíše rekonstruované snapshoty (keyframy a delty jako při
+    běžném zápisu) a promítne je do agregací. Vrací počet zapsaných záznamů.
+    """
+    keyframe = None
+    if snapshots:
+        keyframe = _latest_keyframe(account, snapshots[0][1]['settlement_currency'])
+    for start in range(0, len(snapshots), chunk_size):
+        chunk = snapshots[start:start + chunk_size]
+        for timestamp, summary, positions in chunk:
+            record = build_position_record(summary, positions, timestamp, account, keyframe=keyframe)
+            record.source = 'backfill'
+            db.session.add(record)
+            if config.snapshot_storage != 'delta':
+                continue
+            if record.keyframe_id is None:
+                db.session.flush() # id keyframu potřebují následující delty
+                keyframe = (record.id, positions, 0)
+            else:
+                keyframe = (keyframe[0], keyframe[1], keyframe[2] + 1)
+        update_rollups([(timestamp, summary, account) for timestamp, summary, _ in chunk])
+        bump_history_generation()
+        db.session.commit()
+    return len(snapshots)
+
+
+def backfill_history(client: BybitTrader, days: int, settlement_currency: str = "USDT",
+                     symbols: Optional[List[str]] = None, step_minutes: Optional[int] = None,
+                     workers: Optional[int] = None) -> Dict:
+    """
+    Doplní historii posledních `days` dní: stáhne executions a closed PnL,
+    načte mark price a zapíše snapshoty do mezer. Opakované spuštění
+    pokračuje od checkpointů a nevytváří duplicitní záznamy.
+    """
+    step_minutes = step_minutes or config.scheduler_interval_minutes
+    end = datetime.utcnow().replace(second=0, microsecond=0)
+    start = end - timedelta(days=days)
+    # Zarovnání na mřížku intervalu od epochy, aby se body shodovaly mezi běhy i pro kroky nad hodinu
+    start = start - timedelta(minutes=(_to_ms(start) // 60000) % step_minutes)
+
+    fetched, errors = fetch_backfill_sources(client, start, end, symbols, workers)
+    for error in errors:
+        logging.error(f"Backfill: {error}")
+    if errors:
+        # Bez kompletních obchodů by rekonstrukce byla chybná; další běh naváže od checkpointů
+        return {'fetched': fetched, 'snapshots': 0, 'errors': errors}
+
+    current_positions = client.get_open_positions(settlement_currency, use_cache=False)
+    balance = client.get_account_balance(use_cache=False)
+    wallet_balance = Decimal(str(_parse_equity(balance.get('totalWalletBalance', '0'))))
+    try:
+        settle_coins = fetch_settle_coins(client)
+    except Exception as e:
+        logging.warning(f"Backfill: Seznam kontraktů nelze načíst ({e}), settle coin se určí podle názvu symbolu.")
+        settle_coins = {}
+    traded = {
+        symbol for (symbol,) in db.session.query(BackfillExecution.symbol).filter(
+            BackfillExecution.account == client.account, BackfillExecution.exec_time >= start
+        ).distinct()
+    }
+    traded |= {
+        symbol for (symbol,) in db.session.query(BackfillClosedPnl.symbol).filter(
+            BackfillClosedPnl.account == client.account, BackfillClosedPnl.updated_time >= start
+        ).distinct()
+    }
+    traded = {symbol for symbol in traded if _settle_coin(symbol, settle_coins) == settlement_currency}
+    symbols_to_price = sorted(traded | {pos['symbol'] for pos in current_positions})
+    marks = fetch_mark_prices(client, symbols_to_price, start, end, step_minutes, workers)
+
+    snapshots = reconstruct_snapshots(
+        client.account, settlement_currency, start, end, step_minutes, current_positions, wallet_balance, marks,
+        symbols_to_price
+    )
+    written = write_backfill_snapshots(client.account, snapshots)
+    logging.info(f"Backfill: Účet {client.account} doplněn o {written} snapshotů ({fetched}).")
+    return {'fetched': fetched, 'snapshots': written, 'errors': []}
+
+
+@app.cli.command('backfill-history')
+@click.option('--days', type=int, default=365, show_default=True)
+@click.option('--account', default=DEFAULT_ACCOUNT, show_default=True)
+@click.option('--settle-coin', default="USDT", show_default=True)
+@click.option('--symbols', default=None, help="Čárkou oddělené symboly; bez nich se stahuje vše najednou.")
+@click.option('--step-minutes', type=int, default=None, help="Rozestup doplněných snapshotů (výchozí interval plánovače).")
+@click.option('--workers', type=int, default=None)
+def backfill_history_command(days, account, settle_coin, symbols, step_minutes, workers):
+    """Doplní historii snapshotů z executions a closed PnL na Bybitu."""
+    client = account_traders.get(account)
+    if client is None:
+        raise click.ClickException(f"Účet {account} není nakonfigurován.")
+    migrate_database()
+    result = backfill_history(
+        client, days, settle_coin, [s.strip() for s in symbols.split(',')] if symbols else None, step_minutes, workers
+    )
+    print(f"Staženo: {result['fetched']}, doplněno snapshotů: {result['snapshots']}.")
+    if result['errors']:
+        raise click.ClickException(f"{len(result['errors'])} oken se nepodařilo stáhnout, spusťte příkaz znovu.")
+
+
+# --- Podmíněné GET a komprese odpovědí ---
+# Dashboard se dotazuje opakovaně: nezměněná data dostanou 304 bez těla
+# a větší JSON odpovědi se komprimují (brotli, pokud je nainstalované, jinak gzip).
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/csv', 'text/css', 'application/javascript'}
+
+# Poslední odpověď /positions; v rámci TTL cache se znovu nenačítá ani neserializuje
+_positions_response = {}
+_positions_response_lock = threading.Lock()
+
+
+def _client_has_current(etag: str, last_modified: datetime) -> bool:
+    # If-None-Match má přednost před If-Modified-Since
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    return request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+
+def _with_validators(response: Response, etag: str, last_modified: datetime) -> Response:
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # Prohlížeč se musí pokaždé zeptat serveru, jinak by heuristicky použil starou kopii
+    response.cache_control.no_cache = True
+    return response
+
+
+def _not_modified(etag: str, last_modified: datetime) -> Response:
+    return _with_validators(Response(status=304), etag, last_modified)
+
+
+def _history_version() -> Tuple[str, datetime]:
+    """
+    Verze historie pro podmíněný GET: nový zápis mění nejvyšší id, mazání
+    a přepisy generaci v app_setting. Last-Modified je novější z času
+    posledního snapshotu a poslední změny generace, aby backfill starších dat
+    nebo kompakce nevracely na If-Modified-Since chybně 304. ETag je společný
+    pro všechny parametry, klient ho posílá jen pro stejnou URL.
+    """
+    # Samostatné dotazy na max() využijí index (resp. rowid) a nečtou celou tabulku
+    max_id = db.session.query(func.max(PositionRecord.id)).scalar()
+    newest = db.session.query(func.max(PositionRecord.timestamp)).scalar() or datetime(1970, 1, 1)
+    generation, changed_at = db.session.query(AppSetting.value, AppSetting.updated_at).filter(
+        AppSetting.key == HISTORY_GENERATION_SETTING
+    ).one_or_none() or ('0', None)
+    if changed_at is not None:
+        newest = max(newest, changed_at)
+    return f"{max_id or 0}-{generation}", newest.replace(microsecond=0, tzinfo=timezone.utc)
+
+
+@app.after_request
+def _compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < config.compress_min_bytes:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=config.compress_level))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=config.compress_level))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# Routes
 @app.route('/')
 def index():
     if not trader:
         return render_template('error.html', message="Chyba inicializace API. Zkontrolujte prosím .env soubor.")
-    return render_template('index.html')
+    # Živý stream (SSE) dashboard otevírá, jen pokud v tomto procesu běží WebSocket
+    return render_template('index.html', live_stream=bool(live_stream and live_stream.running))
 
 @app.route('/balance', methods=['GET'])
 def get_balance():
@@ -358,84 +3232,43 @@ def get_positions():
     if not trader:
         return jsonify({"error": "Trading client not initialized."}), 500
     try:
-        positions = trader.get_open_positions()
-        settlement_currency = "USDT"
-
-        total_long_value = Decimal('0')
-        total_short_value = Decimal('0')
-        total_pnl = Decimal('0')
-        long_symbols = []
-        short_symbols = []
-        long_positions_detailed = []
-        short_positions_detailed = []
-
-        balance_info = trader.get_account_balance()
-        total_equity_str = balance_info.get('total_equity', '0')
-        total_equity = Decimal(total_equity_str if total_equity_str != 'N/A' else '0')
-
-
-        for pos in positions:
-            position_value = Decimal(str(abs(float(pos['positionValue']))))
-            unrealized_pnl = Decimal(str(pos['unrealized_pnl']))
-            total_pnl += unrealized_pnl
-
-            if pos['side'] == 'Buy':
-                total_long_value += position_value
-                long_symbols.append(pos['symbol'].replace('USDT', ''))
-                long_positions_detailed.append(pos)
-            else:
-                total_short_value += position_value
-                short_symbols.append(pos['symbol'].replace('USDT', ''))
-                short_positions_detailed.append(pos)
-
-        long_percentage = (total_long_value / total_equity) * 100 if total_equity > 0 else Decimal('0.00')
-        short_percentage = (total_short_value / total_equity) * 100 if total_equity > 0 else Decimal('0.00')
-
-        summary = {
-            'total_long_value': f"{total_long_value:.2f}",
-            'total_short_value': f"{total_short_value:.2f}",
-            'long_percentage': f"{long_percentage:.2f}",
-            'short_percentage': f"{short_percentage:.2f}",
-            'long_symbols': ','.join(long_symbols),
-            'short_symbols': ','.join(short_symbols),
-            'settlement_currency': settlement_currency,
-            'total_pnl': f"{total_pnl:.2f}",
-            'total_equity': f"{total_equity:.2f}"
-        }
+        # Dokud se kniha pozic nezměnila a neuplynulo TTL cache, platí poslední odpověď
+        with _positions_response_lock:
+            cached = dict(_positions_response)
+        if cached and cached['book_version'] == position_book.version and time.monotonic() < cached['expires']:
+            if _client_has_current(cached['etag'], cached['last_modified']):
+                return _not_modified(cached['etag'], cached['last_modified'])
+            return _with_validators(Response(cached['body'], mimetype='application/json'), cached['etag'], cached['last_modified'])
+
+        snapshot = acquire_snapshot()
+        positions = snapshot.positions
+        summary = summarize_positions(positions, snapshot.balance, snapshot.settlement_currency)
+        body = app.json.dumps({
+            "positions": positions,
+            "summary": summary,
+            "stale": snapshot.stale
+        }).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        last_modified = datetime.now(timezone.utc).replace(microsecond=0)
 
-        # Zde je volání scheduled_position_save() pro manuální uložení,
-        # pokud klikneš na "Aktualizovat pozice".
+        # Uložení snapshotu i při manuální aktualizaci z webu ("Aktualizovat pozice").
         # Pokud chceš, aby se ukládalo POUZE automaticky, můžeš tento blok zakomentovat.
-        # Já ho zde nechávám, aby se data uložila i při manuální aktualizaci z webu.
-        try:
-            # Abychom se vyhnuli duplicitnímu kódu, zkusíme volat přímo funkci plánovače.
-            # Musíme ale předat data nebo nechat funkci načíst je sama.
-            # Pro jednoduchost teď duplikuji logiku, ale ideálně by scheduled_position_save
-            # měla přijímat 'positions' a 'summary' jako argumenty.
-            # Prozatím ponecháme stávající logiku pro okamžité uložení.
-            new_record = PositionRecord(
-                total_equity=summary['total_equity'],
-                total_long_value=summary['total_long_value'],
-                total_short_value=summary['total_short_value'],
-                long_percentage=summary['long_percentage'],
-                short_percentage=summary['short_percentage'],
-                long_symbols=summary['long_symbols'],
-                short_symbols=summary['short_symbols'],
-                settlement_currency=summary['settlement_currency'],
-                positions_json=json.dumps(positions),
-                total_pnl=summary['total_pnl'] # Přidáno pro konzistenci
+        # Zastaralá (fallback) data ani snapshot shodný s posledním uloženým se do historie neukládají
+        if config.manual_snapshot_save and not snapshot.stale and etag != cached.get('written_etag'):
+            write_queue.submit(summary, positions)
+            logging.info("Historie pozic manuálně zařazena k uložení do databáze.")
+            cached['written_etag'] = etag
+        with _positions_response_lock:
+            _positions_response.update(
+                body=body, etag=etag, last_modified=last_modified, book_version=position_book.version,
+                # Zastaralá data se necachují, další dotaz zkusí API znovu
+                expires=time.monotonic() + (0 if snapshot.stale else config.cache_ttl_seconds),
+                written_etag=cached.get('written_etag')
             )
-            db.session.add(new_record)
-            db.session.commit()
-            logging.info("Historie pozic manuálně uložena do databáze.")
-        except Exception as db_e:
-            db.session.rollback()
-            logging.error(f"Chyba při manuálním ukládání historie pozic do databáze: {db_e}")
 
-        return jsonify({
-            "positions": positions,
-            "summary": summary
-        })
+        if _client_has_current(etag, last_modified):
+            return _not_modified(etag, last_modified)
+        return _with_validators(Response(body, mimetype='application/json'), etag, last_modified)
     except Exception as e:
         logging.error(f"Chyba při získávání pozic pro web: {e}")
         return jsonify({"error": str(e)}), 500
@@ -460,16 +3293,33 @@ def open_position():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/open_positions', methods=['POST'])
+def open_positions_batch():
+    """
+    Hromadné otevření pozic: {"orders": [{"symbol", "side", "qty", "price", "leverage"?}, ...]}.
+    """
+    if not trader:
+        return jsonify({"error": "Trading client not initialized."}), 500
+    orders = (request.json or {}).get('orders')
+    if not isinstance(orders, list) or not orders:
+        return jsonify({"error": "Pole orders musí být neprázdný seznam objednávek."}), 400
+
+    try:
+        results = trader.open_positions_batch(orders)
+        return jsonify({"message": "Hromadné otevření pozic dokončeno.", "results": results})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/close_position', methods=['POST'])
 def close_position():
     if not trader:
         return jsonify({"error": "Trading client not initialized."}), 500
     data = request.json
     symbol = data.get('symbol')
-    qty = float(data.get('qty'))
+    qty = float(data['qty']) if data.get('qty') else None # bez qty se zavře celá pozice
 
-    if not all([symbol, qty]):
-        return jsonify({"error": "Všechna pole (symbol, qty) jsou povinná."}), 400
+    if not symbol:
+        return jsonify({"error": "Pole symbol je povinné."}), 400
 
     try:
         response = trader.close_position(symbol, qty)
@@ -477,36 +3327,611 @@ def close_position():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/close_positions', methods=['POST'])
+def close_positions():
+    """
+    Zavře všechny pozice, volitelně jen jednu stranu: {"side": "Buy" | "Sell"}.
+    """
+    if not trader:
+        return jsonify({"error": "Trading client not initialized."}), 500
+    side = (request.json or {}).get('side')
+    if side not in (None, "Buy", "Sell"):
+        return jsonify({"error": "Pole side musí být 'Buy' nebo 'Sell'."}), 400
+
+    try:
+        results = trader.close_positions(side)
+        return jsonify({"message": "Hromadné zavření pozic dokončeno.", "results": results})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Sloupce souhrnu, které lze vybrat parametrem ?fields=
+HISTORY_SUMMARY_FIELDS = (
+    'total_equity', 'total_long_value', 'total_short_value',
+    'long_percentage', 'short_percentage', 'long_symbols', 'short_symbols',
+    'settlement_currency', 'total_pnl'
+)
+# Číselné sloupce, které se při ?max_points= agregují po časových úsecích
+HISTORY_NUMERIC_FIELDS = (
+    'total_equity', 'total_long_value', 'total_short_value',
+    'long_percentage', 'short_percentage', 'total_pnl'
+)
+HISTORY_DEFAULT_LIMIT = 5
+HISTORY_MAX_LIMIT = 1000
+# Časové řady jednotlivých symbolů (/history/symbol/<symbol>) vrací víc bodů na stránku
+SYMBOL_HISTORY_DEFAULT_LIMIT = 1000
+SYMBOL_HISTORY_MAX_LIMIT = 10000
+
+
+def _parse_datetime_param(name: str) -> Optional[datetime]:
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"Neplatný formát parametru '{name}', očekáván ISO 8601.")
+    # Timestampy jsou v DB uloženy jako naivní UTC
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _parse_history_fields() -> Tuple[List[str], bool]:
+    value = request.args.get('fields')
+    if not value:
+        return list(HISTORY_SUMMARY_FIELDS), True
+    fields = []
+    include_positions = False
+    for name in (f.strip() for f in value.split(',')):
+        if name == 'summary':
+            fields.extend(f for f in HISTORY_SUMMARY_FIELDS if f not in fields)
+        elif name == 'positions':
+            include_positions = True
+        elif name in HISTORY_SUMMARY_FIELDS:
+            if name not in fields:
+                fields.append(name)
+        elif name:
+            raise ValueError(f"Neznámé pole '{name}'.")
+    return fields, include_positions
+
+
+def _encode_history_cursor(timestamp: datetime, record_id: int) -> str:
+    return f"{timestamp.isoformat()},{record_id}"
+
+
+def _decode_history_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        timestamp, record_id = cursor.rsplit(',', 1)
+        return datetime.fromisoformat(timestamp), int(record_id)
+    except ValueError:
+        raise ValueError("Neplatný kurzor.")
+
+
+def _downsample_history(date_from: Optional[datetime], date_to: Optional[datetime], max_points: int,
+                        account: Optional[str] = None) -> List[Dict]:
+    """
+    Rozdělí interval na max_points stejně dlouhých úseků a pro každý vrátí
+    průměr, minimum a maximum číselných sloupců. Agreguje se v SQL,
+    do Pythonu jde jen jeden řádek na úsek.
+    """
+    if date_from is None or date_to is None:
+        bounds = db.session.query(func.min(PositionRecord.timestamp), func.max(PositionRecord.timestamp))
+        if account is not None:
+            bounds = bounds.filter(PositionRecord.account == account)
+        if date_from is not None:
+            bounds = bounds.filter(PositionRecord.timestamp >= date_from)
+        if date_to is not None:
+            bounds = bounds.filter(PositionRecord.timestamp <= date_to)
+        first, last = bounds.one()
+        if first is None:
+            return []
+        date_from = date_from or first
+        date_to = date_to or last
+
+    # +1 s, aby poslední záznam (timestamp == date_to) spadl ještě do posledního úseku
+    span = (date_to - date_from).total_seconds() + 1
+    epoch = (func.julianday(PositionRecord.timestamp) - 2440587.5) * 86400.0
+    start = date_from.replace(tzinfo=timezone.utc).timestamp()
+    bucket = cast((epoch - start) * max_points / span, db.Integer).label('bucket')
+
+    numeric = {name: cast(getattr(PositionRecord, name), Float) for name in HISTORY_NUMERIC_FIELDS}
+    columns = [bucket, func.count(PositionRecord.id), func.min(PositionRecord.timestamp)]
+    for expr in numeric.values():
+        columns.extend([func.avg(expr), func.min(expr), func.max(expr)])
+
+    query = db.session.query(*columns).filter(PositionRecord.timestamp >= date_from, PositionRecord.timestamp <= date_to)
+    if account is not None:
+        query = query.filter(PositionRecord.account == account)
+    rows = (
+        query
+        .group_by(bucket)
+        .order_by(bucket)
+        .all()
+    )
+
+    result = []
+    for row in rows:
+        point = {
+            'timestamp': datetime.fromisoformat(str(row[2])).strftime('%Y-%m-%d %H:%M:%S'),
+            'count': row[1],
+            'summary': {},
+            'min': {},
+            'max': {}
+        }
+        for i, name in enumerate(HISTORY_NUMERIC_FIELDS):
+            avg_value, min_value, max_value = row[3 + 3 * i:6 + 3 * i]
+            point['summary'][name] = f"{avg_value or 0:.2f}"
+            point['min'][name] = f"{min_value or 0:.2f}"
+            point['max'][name] = f"{max_value or 0:.2f}"
+        result.append(point)
+    return result
+
+
 @app.route('/history', methods=['GET'])
 def get_history():
+    """
+    Parametry (všechny volitelné):
+      from, to    - časový rozsah v ISO 8601 (UTC)
+      limit       - počet záznamů na stránku (výchozí 5, max 1000)
+      cursor      - hodnota hlavičky X-Next-Cursor z předchozí stránky
+      fields      - seznam sloupců souhrnu oddělený čárkou, 'summary' = všechny,
+                    'positions' = přidat detail pozic (bez parametru vše)
+      max_points  - vrátí rozsah zhuštěný na nejvýše max_points úseků
+      account     - jen snapshoty daného účtu
+    """
     try:
-        history_records = PositionRecord.query.order_by(desc(PositionRecord.timestamp)).limit(5).all()
-        history_data = [record.to_dict() for record in history_records]
-        
-        return jsonify(history_data)
+        date_from = _parse_datetime_param('from')
+        date_to = _parse_datetime_param('to')
+        fields, include_positions = _parse_history_fields()
+        limit = min(int(request.args.get('limit', HISTORY_DEFAULT_LIMIT)), HISTORY_MAX_LIMIT)
+        max_points = request.args.get('max_points', type=int)
+        cursor = request.args.get('cursor')
+        cursor = _decode_history_cursor(cursor) if cursor else None
+        account = request.args.get('account')
+        if limit <= 0 or (max_points is not None and max_points <= 0):
+            raise ValueError("Parametry limit a max_points musí být kladná celá čísla.")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        etag, last_modified = _history_version()
+        if _client_has_current(etag, last_modified):
+            return _not_modified(etag, last_modified)
+        if max_points:
+            return _with_validators(jsonify(_downsample_history(date_from, date_to, max_points, account)), etag, last_modified)
+
+        # Načítají se jen vybrané sloupce, positions_json pouze na vyžádání
+        columns = [PositionRecord.id, PositionRecord.timestamp, PositionRecord.account]
+        columns += [getattr(PositionRecord, f) for f in fields]
+        if include_positions:
+            columns += [PositionRecord.positions_json, PositionRecord.positions_blob, PositionRecord.keyframe_id]
+
+        query = db.session.query(*columns)
+        if account is not None:
+            query = query.filter(PositionRecord.account == account)
+        if date_from is not None:
+            query = query.filter(PositionRecord.timestamp >= date_from)
+        if date_to is not None:
+            query = query.filter(PositionRecord.timestamp <= date_to)
+        if cursor is not None:
+            cursor_timestamp, cursor_id = cursor
+            query = query.filter(or_(
+                PositionRecord.timestamp < cursor_timestamp,
+                and_(PositionRecord.timestamp == cursor_timestamp, PositionRecord.id < cursor_id)
+            ))
+        rows = query.order_by(desc(PositionRecord.timestamp), desc(PositionRecord.id)).limit(limit).all()
+
+        history_data = []
+        for row in rows:
+            item = {
+                'timestamp': row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'account': row.account,
+                'summary': {f: getattr(row, f) for f in fields}
+            }
+            if include_positions:
+                item['positions'] = load_positions(row.positions_json, row.positions_blob, row.keyframe_id)
+            history_data.append(item)
+
+        response = _with_validators(jsonify(history_data), etag, last_modified)
+        if len(rows) == limit:
+            response.headers['X-Next-Cursor'] = _encode_history_cursor(rows[-1].timestamp, rows[-1].id)
+        return response
     except Exception as e:
         return jsonify({"error": f"Chyba při načítání historie z databáze: {e}"}), 500
 
+@app.route('/history/symbol/<symbols>', methods=['GET'])
+def get_symbol_history(symbols):
+    """
+    Vývoj pozic jednoho nebo více symbolů (oddělených čárkou) z tabulky
+    position_item. Dotaz jde přes index (symbol, timestamp), takže jeho cena
+    odpovídá počtu vrácených bodů, ne velikosti historie. Tabulka pokrývá
+    jen posledních position_items_days dní.
+    Parametry (všechny volitelné):
+      from, to  - časový rozsah v ISO 8601 (UTC)
+      limit     - počet bodů na stránku (výchozí 1000, max 10000)
+      cursor    - hodnota hlavičky X-Next-Cursor z předchozí stránky
+      account   - jen snapshoty daného účtu
+    """
+    try:
+        symbol_list = list(dict.fromkeys(s.strip().upper() for s in symbols.split(',') if s.strip()))
+        date_from = _parse_datetime_param('from')
+        date_to = _parse_datetime_param('to')
+        limit = min(int(request.args.get('limit', SYMBOL_HISTORY_DEFAULT_LIMIT)), SYMBOL_HISTORY_MAX_LIMIT)
+        cursor = request.args.get('cursor')
+        cursor = _decode_history_cursor(cursor) if cursor else None
+        account = request.args.get('account')
+        if not symbol_list:
+            raise ValueError("Zadejte alespoň jeden symbol.")
+        if limit <= 0:
+            raise ValueError("Parametr limit musí být kladné celé číslo.")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        etag, last_modified = _history_version()
+        if _client_has_current(etag, last_modified):
+            return _not_modified(etag, last_modified)
+        query = db.session.query(
+            PositionItem.id, PositionItem.timestamp, PositionItem.symbol, PositionItem.side, PositionItem.size,
+            PositionItem.position_value, PositionItem.unrealised_pnl, PositionItem.avg_price
+        ).filter(PositionItem.symbol.in_(symbol_list))
+        if account is not None:
+            # Účet je jen u snapshotu; JOIN přes primární klíč se dělá jen pro nalezené řádky
+            query = query.join(PositionRecord, PositionRecord.id == PositionItem.record_id).filter(PositionRecord.account == account)
+        if date_from is not None:
+            query = query.filter(PositionItem.timestamp >= date_from)
+        if date_to is not None:
+            query = query.filter(PositionItem.timestamp <= date_to)
+        if cursor is not None:
+            cursor_timestamp, cursor_id = cursor
+            query = query.filter(or_(
+                PositionItem.timestamp > cursor_timestamp,
+                and_(PositionItem.timestamp == cursor_timestamp, PositionItem.id > cursor_id)
+            ))
+        rows = query.order_by(PositionItem.timestamp, PositionItem.id).limit(limit).all()
+
+        series = {symbol: [] for symbol in symbol_list}
+        for row in rows:
+            series[row.symbol].append({
+                'timestamp': row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'side': row.side,
+                'size': row.size,
+                'position_value': row.position_value,
+                'unrealised_pnl': row.unrealised_pnl,
+                'avg_price': row.avg_price
+            })
+
+        response = _with_validators(jsonify(series), etag, last_modified)
+        if len(rows) == limit:
+            response.headers['X-Next-Cursor'] = _encode_history_cursor(rows[-1].timestamp, rows[-1].id)
+        return response
+    except Exception as e:
+        return jsonify({"error": f"Chyba při načítání historie symbolu z databáze: {e}"}), 500
+
+SSE_KEEPALIVE_SECONDS = 15
+
+def _sse_event(event: Dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+@app.route('/stream')
+def stream():
+    """
+    Server-Sent Events: nejdřív celý stav knihy pozic, pak delty
+    (event "position" a "wallet") tak, jak přicházejí z WebSocketu.
+    Bez spuštěného WebSocketu (viz start_live_stream) vrací 503.
+    """
+    if not (live_stream and live_stream.running):
+        return jsonify({"error": "Živý stream pozic v tomto procesu neběží."}), 503
+    subscription = position_book.subscribe()
+
+    def generate():
+        try:
+            yield _sse_event(position_book.snapshot())
+            while True:
+                try:
+                    event = subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event['type'] == 'resync':
+                    event = position_book.snapshot()
+                yield _sse_event(event)
+        finally:
+            position_book.unsubscribe(subscription)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    if not trader:
+        return jsonify({"error": "Trading client not initialized."}), 500
+    return jsonify(trader.cache.stats())
+
+@app.route('/history/rollups', methods=['GET'])
+def get_history_rollups():
+    """
+    Agregovaná historie: ?resolution=1h|1d|1w (výchozí 1h), volitelně from/to,
+    account (výchozí hlavní účet) a settlement_currency (výchozí USDT).
+    """
+    resolution = request.args.get('resolution', '1h')
+    account = request.args.get('account', DEFAULT_ACCOUNT)
+    settlement_currency = request.args.get('settlement_currency', 'USDT')
+    if resolution not in ROLLUP_RESOLUTIONS:
+        return jsonify({"error": f"Neplatné rozlišení, povolené hodnoty: {', '.join(ROLLUP_RESOLUTIONS)}."}), 400
+    try:
+        date_from = _parse_datetime_param('from')
+        date_to = _parse_datetime_param('to')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        query = EquityRollup.query.filter(
+            EquityRollup.account == account,
+            EquityRollup.settlement_currency == settlement_currency,
+            EquityRollup.resolution == resolution
+        )
+        if date_from is not None:
+            query = query.filter(EquityRollup.bucket_start >= rollup_bucket_start(date_from, resolution))
+        if date_to is not None:
+            query = query.filter(EquityRollup.bucket_start <= date_to)
+        return jsonify([rollup.to_dict() for rollup in query.order_by(EquityRollup.bucket_start).all()])
+    except Exception as e:
+        return jsonify({"error": f"Chyba při načítání agregací z databáze: {e}"}), 500
+
+# --- Export historie (CSV / Parquet / Arrow IPC) ---
+# Data se čtou po dávkách (keyset podle timestamp, id) a výstup se generuje
+# průběžně, takže spotřeba paměti nezávisí na velikosti exportu.
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows')
+}
+EXPORT_SNAPSHOT_COLUMNS = (
+    ('id', 'int64'), ('timestamp', 'timestamp'),
+    ('total_equity', 'float64'), ('total_long_value', 'float64'), ('total_short_value', 'float64'),
+    ('long_percentage', 'float64'), ('short_percentage', 'float64'), ('total_pnl', 'float64'),
+    ('long_symbols', 'string'), ('short_symbols', 'string'), ('settlement_currency', 'string'),
+    ('account', 'string')
+)
+EXPORT_POSITION_COLUMNS = (
+    ('record_id', 'int64'), ('timestamp', 'timestamp'), ('symbol', 'string'), ('side', 'string'),
+    ('size', 'float64'), ('position_value', 'float64'), ('unrealised_pnl', 'float64'),
+    ('avg_price', 'float64'), ('created_time', 'string')
+)
+
+
+def _iter_snapshot_chunks(date_from: Optional[datetime], date_to: Optional[datetime], chunk_size: int):
+    columns = []
+    for name, kind in EXPORT_SNAPSHOT_COLUMNS:
+        column = getattr(PositionRecord, name)
+        columns.append(cast(column, Float) if kind == 'float64' else column)
+
+    cursor = None
+    while True:
+        query = db.session.query(*columns)
+        if date_from is not None:
+            query = query.filter(PositionRecord.timestamp >= date_from)
+        if date_to is not None:
+            query = query.filter(PositionRecord.timestamp <= date_to)
+        if cursor is not None:
+            query = query.filter(or_(
+                PositionRecord.timestamp > cursor[0],
+                and_(PositionRecord.timestamp == cursor[0], PositionRecord.id > cursor[1])
+            ))
+        rows = query.order_by(PositionRecord.timestamp, PositionRecord.id).limit(chunk_size).all()
+        if not rows:
+            return
+        yield rows
+        cursor = (rows[-1][1], rows[-1][0])
+
+
+def _iter_position_chunks(date_from: Optional[datetime], date_to: Optional[datetime], chunk_size: int):
+    # Pozice se dohledávají přes dávky snapshotů, aby se využil index na record_id
+    columns = [getattr(PositionItem, name) for name, _ in EXPORT_POSITION_COLUMNS]
+    records_per_chunk = max(chunk_size // 20, 1)
+    cutoff = position_items_cutoff()
+    for records in _iter_snapshot_chunks(date_from, date_to, records_per_chunk):
+        rows = (
+            db.session.query(*columns)
+            .filter(PositionItem.record_id.in_([record[0] for record in records]))
+            .order_by(PositionItem.timestamp, PositionItem.record_id, PositionItem.id)
+            .all()
+        )
+        # Snapshoty mimo okno position_items_days nemají řádky position_item, pozice se dekódují ze záznamu
+        with_items = {row[0] for row in rows}
+        missing = [record[0] for record in records if record[1] < cutoff and record[0] not in with_items]
+        if missing:
+            for record_id, timestamp, positions_json, positions_blob, keyframe_id in (
+                db.session.query(PositionRecord.id, PositionRecord.timestamp, PositionRecord.positions_json,
+                                 PositionRecord.positions_blob, PositionRecord.keyframe_id)
+                .filter(PositionRecord.id.in_(missing))
+            ):
+                for pos in load_positions(positions_json, positions_blob, keyframe_id):
+                    row = PositionItem.row_from_position(pos, timestamp, record_id)
+                    rows.append(tuple(row[name] for name, _ in EXPORT_POSITION_COLUMNS))
+            rows.sort(key=lambda row: (row[1], row[0]))
+        if rows:
+            yield rows
+
+
+class _ChunkSink:
+    # Minimální zapisovatelný "soubor" pro pyarrow; obsah se průběžně vybírá přes drain()
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _arrow_schema(columns):
+    import pyarrow as pa
+    types = {'int64': pa.int64(), 'float64': pa.float64(), 'string': pa.string(), 'timestamp': pa.timestamp('us')}
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def iter_history_export(table: str, export_format: str, date_from: Optional[datetime] = None,
+                        date_to: Optional[datetime] = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Generátor bajtů exportu. table = 'snapshots' (souhrny) nebo 'positions'
+    (jednotlivé pozice), export_format = 'csv', 'parquet' nebo 'arrow'.
+    """
+    if table == 'snapshots':
+        columns, chunks = EXPORT_SNAPSHOT_COLUMNS, _iter_snapshot_chunks(date_from, date_to, chunk_size)
+    elif table == 'positions':
+        columns, chunks = EXPORT_POSITION_COLUMNS, _iter_position_chunks(date_from, date_to, chunk_size)
+    else:
+        raise ValueError(f"Neznámá tabulka '{table}', povolené hodnoty: snapshots, positions.")
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Neznámý formát '{export_format}', povolené hodnoty: {', '.join(EXPORT_FORMATS)}.")
+
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([name for name, _ in columns])
+        for rows in chunks:
+            writer.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    if export_format == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in chunks:
+            batch = pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                schema=schema
+            )
+            writer.write_batch(batch)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+@app.route('/history/export', methods=['GET'])
+def export_history():
+    """
+    Stažení historie: ?format=csv|parquet|arrow (výchozí csv),
+    ?table=snapshots|positions (výchozí snapshots), volitelně from/to.
+    """
+    export_format = request.args.get('format', 'csv')
+    table = request.args.get('table', 'snapshots')
+    try:
+        date_from = _parse_datetime_param('from')
+        date_to = _parse_datetime_param('to')
+        if export_format not in EXPORT_FORMATS or table not in ('snapshots', 'positions'):
+            raise ValueError("Neplatný formát nebo tabulka exportu.")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    return Response(
+        stream_with_context(iter_history_export(table, export_format, date_from, date_to)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=history-{table}.{extension}'}
+    )
+
+
+@app.cli.command('export-history')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv')
+@click.option('--table', type=click.Choice(['snapshots', 'positions']), default='snapshots')
+@click.option('--from', 'date_from', type=click.DateTime(), default=None)
+@click.option('--to', 'date_to', type=click.DateTime(), default=None)
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), required=True)
+def export_history_command(export_format, table, date_from, date_to, output):
+    """Vyexportuje historii snapshotů nebo pozic do souboru."""
+    written = 0
+    with open(output, 'wb') as f:
+        for data in iter_history_export(table, export_format, date_from, date_to):
+            f.write(data)
+            written += len(data)
+    print(f"Zapsáno {written} bajtů do {output}.")
+
+@app.cli.command('run-collector')
+@click.option('--metrics-port', type=int, default=None,
+              help="Port pro /metrics kolektoru (výchozí COLLECTOR_METRICS_PORT, 0 = vypnuto).")
+def run_collector_command(metrics_port):
+    """Spustí samostatný kolektor snapshotů (plánovač bez webového serveru)."""
+    with app.app_context():
+        migrate_database()
+    # Metriky plánovače a zápisu do DB vznikají jen v tomto procesu, web je nevidí
+    metrics_port = config.collector_metrics_port if metrics_port is None else metrics_port
+    metrics_server = serve_metrics(metrics_port) if metrics_port else None
+    if metrics_server:
+        logging.info(f"Kolektor: Metriky na http://0.0.0.0:{metrics_port}/metrics.")
+    # docker stop / systemd posílají SIGTERM; bez handleru by proces skončil bez úklidu
+    def _terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, _terminate)
+
+    start_collector()
+    try:
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        # Nejdřív doběhnou rozpracované úlohy, pak se dopíše fronta a uvolní lease pro zálohu
+        scheduler.shutdown()
+        write_queue.stop()
+        collector_lease.release()
+        if metrics_server:
+            metrics_server.shutdown()
+        logging.info("Kolektor ukončen.")
+
 # Endpoint pro získání/nastavení intervalu plánovače
 @app.route('/scheduler_interval', methods=['GET', 'POST'])
 def scheduler_interval():
+    # Interval je uložen v DB, odkud si ho převezme kolektor (i v jiném procesu)
     if request.method == 'GET':
-        return jsonify({"interval_minutes": config.scheduler_interval_minutes})
+        try:
+            interval = int(get_setting(SCHEDULER_INTERVAL_SETTING, config.scheduler_interval_minutes))
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        return jsonify({"interval_minutes": interval})
     elif request.method == 'POST':
         data = request.json
         new_interval = data.get('interval_minutes')
         if new_interval and isinstance(new_interval, int) and new_interval > 0:
-            config.scheduler_interval_minutes = new_interval
-            # Změnit úlohu v plánovači
+            try:
+                set_setting(SCHEDULER_INTERVAL_SETTING, str(new_interval))
+            except Exception as e:
+                return jsonify({"error": str(e)}), 500
+            # Kolektor běžící v tomto procesu změnu promítne hned, jinak při další obnově lease
             if scheduler.running:
-                scheduler.remove_job('scheduled_position_save_job') # Odeber starou úlohu
-                scheduler.add_job(
-                    id='scheduled_position_save_job',
-                    func=scheduled_position_save,
-                    trigger='interval',
-                    minutes=config.scheduler_interval_minutes,
-                    replace_existing=True
-                )
+                config.scheduler_interval_minutes = new_interval
+                _schedule_position_save(new_interval)
                 logging.info(f"Interval plánovače změněn na {new_interval} minut.")
             return jsonify({"message": f"Interval aktualizován na {new_interval} minut."}), 200
         return jsonify({"error": "Neplatný interval. Musí být kladné celé číslo."}), 400
@@ -514,19 +3939,14 @@ def scheduler_interval():
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
-
-    # Inicializace a spuštění plánovače
-    scheduler.init_app(app)
-    # Přidání úlohy
-    scheduler.add_job(
-        id='scheduled_position_save_job',
-        func=scheduled_position_save,
-        trigger='interval',
-        minutes=config.scheduler_interval_minutes, # Použijeme konfigurovatelný interval
-        max_instances=1 # Zabrání souběžnému spuštění více instancí úlohy
-    )
-    scheduler.start()
-    logging.info(f"Plánovač spuštěn s intervalem {config.scheduler_interval_minutes} minut.")
+        migrate_database() # Vytvoří tabulky/indexy a doplní position_item pro starší záznamy
+
+    # Vývojový server s vestavěným kolektorem; pokud běží samostatný kolektor
+    # (run-collector), drží lease on a vestavěný plánovač jen čeká v záloze.
+    # Zapisuje tu tentýž proces, ruční načtení /positions se proto ukládá, není-li řečeno jinak
+    if os.getenv('MANUAL_SNAPSHOT_SAVE') is None:
+        config.manual_snapshot_save = True
+    start_collector()
+    start_live_stream()
 
     app.run(debug=True, use_reloader=False) # use_reloader=False je důležité pro APScheduler, aby se úloha nespustila dvakrát
\ No newline at end of file
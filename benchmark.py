@@ -0,0 +1,815 @@
+"""
+Offline benchmark aplikace bez přístupu na burzu.
+
+Spustí lokální náhradu Bybit REST API (nahrané nebo syntetické odpovědi
+s nastavitelnou latencí a počtem pozic), naplní samostatnou databázi
+zadaným počtem snapshotů a měří /positions, /balance, /history
+a scheduled_position_save při souběžné zátěži.
+
+    python benchmark.py run --sizes 10000,100000,1000000 --output bench/nova.json --baseline bench/stara.json
+    python benchmark.py record --output recording.json
+    python benchmark.py stream
+
+`record` uloží odpovědi get_positions a get_wallet_balance z živého účtu
+(jen čtení); odpovědi na objednávky jsou vždy syntetické. `stream` spustí
+lokální náhradu privátního WebSocketu a ověří, že zprávy position a wallet
+i obnovení spojení projdou přes PositionBook až do /stream (SSE).
+"""
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import os
+import platform
+import queue
+import random
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import requests
+
+# Snapshoty se při plnění databáze rozloží od tohoto okamžiku po minutách
+SEED_START = datetime(2020, 1, 1)
+SEED_CHUNK_SIZE = 10000
+# Počet různých variant ocenění pozic, ze kterých se skládají plněné snapshoty
+SEED_VARIANTS = 97
+
+
+# --- Náhrada Bybit REST API ---
+def synthetic_positions(count: int, templates: Optional[List[Dict]] = None) -> List[Dict]:
+    """
+    Pozice ve formátu odpovědi /v5/position/list. S nahranými šablonami se
+    použijí ty (cyklicky, s přejmenovanými symboly), jinak syntetické.
+    """
+    positions = []
+    for i in range(count):
+        if templates:
+            pos = dict(templates[i % len(templates)])
+            if i >= len(templates):
+                pos['symbol'] = f"{pos['symbol'][:-4]}{i}{pos['symbol'][-4:]}"
+        else:
+            price = 10 + i
+            size = 1 + i % 7
+            pos = {
+                'symbol': f"SYM{i}USDT",
+                'side': 'Buy' if i % 3 else 'Sell',
+                'size': str(size),
+                'avgPrice': str(price),
+                'positionValue': f"{price * size:.4f}",
+                'unrealisedPnl': f"{(i % 11 - 5) * 0.37:.4f}",
+                'createdTime': str(1700000000000 + i * 60000),
+                'leverage': "5",
+                'settleCoin': "USDT"
+            }
+        positions.append(pos)
+    return positions
+
+
+def _move_marks(positions: List[Dict]) -> List[Dict]:
+    # Každá odpověď má mírně jiné ocenění, stejně jako živý trh
+    moved = []
+    for pos in positions:
+        pos = dict(pos)
+        factor = 1 + random.uniform(-0.002, 0.002)
+        pos['positionValue'] = f"{float(pos['positionValue']) * factor:.4f}"
+        pos['unrealisedPnl'] = f"{float(pos['unrealisedPnl']) + random.uniform(-0.5, 0.5):.4f}"
+        moved.append(pos)
+    return moved
+
+
+class FakeBybit:
+    """
+    Lokální HTTP server s endpointy, které aplikace volá. Odpovídá po
+    `latency_ms` (+ náhodně až `jitter_ms`) a posílá hlavičky rate limitu.
+    """
+    def __init__(self, positions: List[Dict], wallet: Dict, latency_ms: float, jitter_ms: float = 0.0):
+        self.positions = positions
+        self.wallet = wallet
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.requests = 0
+        self._order_ids = itertools.count(1)
+        self._server = None
+
+    def start(self) -> str:
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-bybit', daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def respond(self, method: str, path: str, query: Dict, body: Dict) -> Dict:
+        self.requests += 1
+        if path == '/v5/position/list':
+            settle_coin = query.get('settleCoin', ['USDT'])[0]
+            positions = [pos for pos in self.positions if pos.get('settleCoin', 'USDT') == settle_coin]
+            return {'retCode': 0, 'retMsg': 'OK', 'result': {'list': _move_marks(positions), 'category': 'linear'}}
+        if path == '/v5/account/wallet-balance':
+            return {'retCode': 0, 'retMsg': 'OK', 'result': {'list': [self.wallet]}}
+        if path == '/v5/position/set-leverage':
+            return {'retCode': 0, 'retMsg': 'OK', 'result': {}}
+        if path == '/v5/order/create':
+            return {'retCode': 0, 'retMsg': 'OK', 'result': {'orderId': str(next(self._order_ids)), 'orderLinkId': ''}}
+        if path == '/v5/order/create-batch':
+            legs = body.get('request', [])
+            return {
+                'retCode': 0, 'retMsg': 'OK',
+                'result': {'list': [{'orderId': str(next(self._order_ids)), 'symbol': leg.get('symbol')} for leg in legs]},
+                'retExtInfo': {'list': [{'code': 0, 'msg': 'OK'} for _ in legs]}
+            }
+        return {'retCode': 10001, 'retMsg': f"Neznámý endpoint {path}", 'result': {}}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive jako u skutečného API
+
+            def do_GET(self):
+                self._reply({})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                self._reply(json.loads(raw) if raw else {})
+
+            def _reply(self, body: Dict):
+                delay = fake.latency_ms + random.uniform(0, fake.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+                url = urlsplit(self.path)
+                payload = json.dumps(fake.respond(self.command, url.path, parse_qs(url.query), body)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.send_header('X-Bapi-Limit', '600')
+                self.send_header('X-Bapi-Limit-Status', '599')
+                self.send_header('X-Bapi-Limit-Reset-Timestamp', str(int(time.time() * 1000) + 1000))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def default_wallet() -> Dict:
+    return {
+        'totalEquity': "100000", 'availableBalance': "60000", 'totalMargin': "40000",
+        'totalWalletBalance': "99000", 'coin': [{'coin': "USDT", 'walletBalance': "99000"}]
+    }
+
+
+# --- Náhrada privátního WebSocketu Bybit ---
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_OPCODE_TEXT, WS_OPCODE_CLOSE, WS_OPCODE_PING, WS_OPCODE_PONG = 0x1, 0x8, 0x9, 0xA
+
+
+class _FakeWebSocketClient:
+    # Jedno spojení: odeslání rámců a stav autentizace/odběrů
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+        self.authenticated = False
+        self.topics: Set[str] = set()
+        self._send_lock = threading.Lock()
+
+    def send(self, payload: bytes, opcode: int = WS_OPCODE_TEXT):
+        # Rámce serveru se nemaskují
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self._send_lock:
+            self.connection.sendall(header + payload)
+
+    def send_json(self, message: Dict):
+        self.send(json.dumps(message).encode('utf-8'))
+
+
+class FakeBybitWebSocket:
+    """
+    Lokální WebSocket server s protokolem privátního streamu Bybit V5:
+    odpovídá na op auth, subscribe a ping a rozesílá zprávy topiců
+    position/wallet odebírajícím klientům. drop() spojení bez close rámce
+    přeruší, jako by spadla síť, a klient se musí znovu připojit.
+    """
+    def __init__(self):
+        self.connections = 0 # počet navázaných spojení (včetně obnovených)
+        self._clients: List[_FakeWebSocketClient] = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._message_ids = itertools.count(1)
+        self._server = None
+
+    def start(self) -> str:
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-bybit-ws', daemon=True).start()
+        return f"ws://127.0.0.1:{self._server.server_address[1]}/v5/private"
+
+    def stop(self):
+        self.drop()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def publish(self, topic: str, data: List[Dict]) -> int:
+        """
+        Pošle zprávu topicu všem přihlášeným odběratelům; vrací jejich počet.
+        """
+        message = {
+            'id': f"fake-{next(self._message_ids)}",
+            'topic': topic,
+            'creationTime': int(time.time() * 1000),
+            'data': data
+        }
+        with self._lock:
+            clients = [client for client in self._clients if client.authenticated and topic in client.topics]
+        for client in clients:
+            client.send_json(message)
+        return len(clients)
+
+    def drop(self):
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            try:
+                client.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.connection.close()
+
+    def wait_subscribed(self, topics: Set[str], connections: int = 1, timeout: float = 10.0) -> bool:
+        """
+        Počká, až `connections`-té spojení projde autentizací a odebírá `topics`.
+        """
+        def ready():
+            return self.connections >= connections and any(
+                client.authenticated and topics <= client.topics for client in self._clients
+            )
+
+        with self._changed:
+            return self._changed.wait_for(ready, timeout=timeout)
+
+    def _handle_message(self, client: _FakeWebSocketClient, message: Dict):
+        op = message.get('op')
+        reply = {'success': True, 'ret_msg': '', 'op': op, 'conn_id': f"fake-{id(client):x}"}
+        if message.get('req_id'):
+            reply['req_id'] = message['req_id']
+        if op == 'auth':
+            with self._changed:
+                client.authenticated = True
+                self._changed.notify_all()
+        elif op == 'subscribe':
+            with self._changed:
+                client.topics.update(message.get('args', []))
+                self._changed.notify_all()
+        elif op == 'ping':
+            reply.update(op='pong', ret_msg='pong')
+        else:
+            reply.update(success=False, ret_msg=f"Neznámá operace {op}")
+        client.send_json(reply)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                headers = {}
+                self.rfile.readline() # GET /v5/private HTTP/1.1
+                while True:
+                    line = self.rfile.readline().decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                accept = base64.b64encode(hashlib.sha1(headers['sec-websocket-key'].encode() + WS_GUID).digest())
+                self.wfile.write(
+                    b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                    b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n'
+                )
+                self.wfile.flush()
+
+                client = _FakeWebSocketClient(self.connection)
+                with fake._changed:
+                    fake._clients.append(client)
+                    fake.connections += 1
+                    fake._changed.notify_all()
+                try:
+                    while True:
+                        frame = self._read_frame()
+                        if frame is None:
+                            return
+                        opcode, payload = frame
+                        if opcode == WS_OPCODE_TEXT:
+                            fake._handle_message(client, json.loads(payload))
+                        elif opcode == WS_OPCODE_PING:
+                            client.send(payload, WS_OPCODE_PONG)
+                        elif opcode == WS_OPCODE_CLOSE:
+                            client.send(payload[:2], WS_OPCODE_CLOSE)
+                            return
+                except OSError:
+                    return
+                finally:
+                    with fake._lock:
+                        if client in fake._clients:
+                            fake._clients.remove(client)
+
+            def _read_frame(self):
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    return None
+                opcode, length = header[0] & 0x0F, header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('!H', self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', self.rfile.read(8))[0]
+                # Rámce klienta jsou vždy maskované
+                mask = self.rfile.read(4) if header[1] & 0x80 else b'\0\0\0\0'
+                payload = self.rfile.read(length)
+                return opcode, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+        return Handler
+
+
+# --- Měření ---
+def summarize_latencies(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    values = np.asarray(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'mean_ms': round(float(values.mean()), 3)
+    }
+
+
+def run_concurrent(task, total: int, concurrency: int) -> Dict:
+    """
+    Provede `task()` celkem `total`-krát v `concurrency` vláknech. task vrací
+    True při úspěchu; měří se latence každého volání i celková propustnost.
+    """
+    counter = itertools.count()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def worker():
+        local_latencies, local_errors = [], 0
+        while next(counter) < total:
+            started = time.perf_counter()
+            try:
+                ok = task()
+            except Exception:
+                ok = False
+            local_latencies.append(time.perf_counter() - started)
+            local_errors += 0 if ok else 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize_latencies(latencies, sum(errors), time.perf_counter() - started)
+
+
+def http_task(base_url: str, path: str):
+    local = threading.local()
+
+    def task() -> bool:
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        response = local.session.get(base_url + path, timeout=60)
+        response.content # dočtení i streamovaných odpovědí
+        return response.status_code < 400
+
+    return task
+
+
+# --- Plnění databáze ---
+def seed_snapshots(A, target: int, position_count: int, templates: Optional[List[Dict]], with_items: bool) -> int:
+    """
+    Doplní tabulku position_record na `target` záznamů (keyframy a delty jako
+    při běžném zápisu). Vrací počet vložených záznamů. Rollupy se neplní.
+    """
+    from sqlalchemy import func, insert
+
+    with A.app.app_context():
+        current = A.db.session.query(func.count(A.PositionRecord.id)).scalar()
+        if current >= target:
+            return 0
+        next_id = (A.db.session.query(func.max(A.PositionRecord.id)).scalar() or 0) + 1
+
+        base = synthetic_positions(position_count, templates)
+        balance = A.BybitTrader.normalize_balance(default_wallet())
+        variants = []
+        for _ in range(SEED_VARIANTS):
+            positions = [A.BybitTrader.normalize_position(pos) for pos in _move_marks(base)]
+            variants.append((positions, A.summarize_positions(positions, balance, 'USDT')))
+        keyframe_blob = A.encode_keyframe(variants[0][0])
+        delta_blobs = [A.encode_delta(positions, variants[0][0]) for positions, _ in variants]
+
+        interval = A.config.snapshot_keyframe_interval
+        keyframe_id = None
+        inserted = 0
+        while inserted < target - current:
+            records, items = [], []
+            for _ in range(min(SEED_CHUNK_SIZE, target - current - inserted)):
+                record_id = next_id + inserted
+                variant = inserted % SEED_VARIANTS
+                positions, summary = variants[variant]
+                timestamp = SEED_START + timedelta(minutes=record_id)
+                is_keyframe = keyframe_id is None or inserted % interval == 0 or delta_blobs[variant] is None
+                if is_keyframe:
+                    keyframe_id = record_id
+                    positions, summary = variants[0]
+                records.append({
+                    'id': record_id,
+                    'timestamp': timestamp,
+                    'account': A.DEFAULT_ACCOUNT,
+                    'total_equity': summary['total_equity'],
+                    'total_long_value': summary['total_long_value'],
+                    'total_short_value': summary['total_short_value'],
+                    'long_percentage': summary['long_percentage'],
+                    'short_percentage': summary['short_percentage'],
+                    'long_symbols': summary['long_symbols'],
+                    'short_symbols': summary['short_symbols'],
+                    'settlement_currency': summary['settlement_currency'],
+                    'total_pnl': summary['total_pnl'],
+                    'positions_blob': keyframe_blob if is_keyframe else delta_blobs[variant],
+                    'keyframe_id': None if is_keyframe else keyframe_id
+                })
+                if with_items:
+                    items.extend(A.PositionItem.row_from_position(pos, timestamp, record_id) for pos in positions)
+                inserted += 1
+            A.db.session.execute(insert(A.PositionRecord), records)
+            if items:
+                A.db.session.execute(insert(A.PositionItem), items)
+            A.db.session.commit()
+            print(f"Plnění databáze: {current + inserted}/{target} snapshotů.", file=sys.stderr)
+        return inserted
+
+
+def count_snapshots(A) -> int:
+    from sqlalchemy import func
+    with A.app.app_context():
+        return A.db.session.query(func.count(A.PositionRecord.id)).scalar()
+
+
+# --- Scénáře ---
+def history_queries(A) -> Dict[str, str]:
+    from sqlalchemy import func
+    with A.app.app_context():
+        first, last = A.db.session.query(func.min(A.PositionRecord.timestamp), func.max(A.PositionRecord.timestamp)).one()
+    last_day = last - timedelta(days=1)
+    fmt = lambda value: value.strftime('%Y-%m-%dT%H:%M:%S')
+    return {
+        'latest': '/history',
+        'page_1000_summary': '/history?limit=1000&fields=summary',
+        'full_range_500_points': f"/history?from={fmt(first)}&to={fmt(last)}&max_points=500",
+        'last_day_positions': f"/history?from={fmt(last_day)}&to={fmt(last)}&limit=1000&fields=positions"
+    }
+
+
+def benchmark_size(A, base_url: str, args) -> Dict:
+    results = {'snapshots': count_snapshots(A), 'endpoints': {}, 'history_query': {}}
+
+    for name, path in (('positions', '/positions'), ('balance', '/balance'), ('history', '/history')):
+        results['endpoints'][name] = run_concurrent(http_task(base_url, path), args.requests, args.concurrency)
+    A.write_queue.flush()
+
+    for name, path in history_queries(A).items():
+        results['history_query'][name] = run_concurrent(http_task(base_url, path), args.history_repeats, 1)
+
+    # scheduled_position_save: každý běh načte data z API znovu (bez cache odpovědí).
+    # Rychlost zápisu se počítá jen z doby zápisu dávek včetně commitu (metrika
+    # db_write_duration_seconds), ne z celkového času, který určuje interval
+    # dopisování fronty a latence API.
+    def scheduled_run() -> bool:
+        A.trader.cache.invalidate()
+        A.scheduled_position_save()
+        return True
+
+    before = count_snapshots(A)
+    write_seconds_before = _db_write_seconds(A)
+    scheduler = run_concurrent(scheduled_run, args.scheduler_runs, args.concurrency)
+    A.write_queue.flush()
+    write_seconds = _db_write_seconds(A) - write_seconds_before
+    written = count_snapshots(A) - before
+    results['scheduled_position_save'] = scheduler
+    results['db_write'] = {
+        'records': written,
+        'write_seconds': round(write_seconds, 4),
+        'records_per_second': round(written / write_seconds, 2) if write_seconds > 0 else None
+    }
+    return results
+
+
+def _db_write_seconds(A) -> float:
+    # Součet histogramu db_write_duration_seconds (doba _write včetně commitu)
+    state = A.db_write_seconds._values.get(())
+    return state[1] if state else 0.0
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(value, prefix: str = '') -> Dict[str, float]:
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(_flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+        return flat
+    return {prefix: value} if isinstance(value, (int, float)) and not isinstance(value, bool) else {}
+
+
+def compare_with_baseline(results: Dict, baseline: Dict):
+    current, previous = _flatten(results['results']), _flatten(baseline.get('results', {}))
+    print(f"\nPorovnání s baseline {baseline.get('meta', {}).get('revision')} ({baseline.get('meta', {}).get('started')}):")
+    for key in sorted(current):
+        if key not in previous or not previous[key]:
+            continue
+        change = (current[key] - previous[key]) / previous[key] * 100
+        print(f"  {key:70s} {previous[key]:>12} -> {current[key]:>12} ({change:+.1f} %)")
+
+
+def print_results(results: Dict):
+    for size, result in results['results'].items():
+        print(f"\n== {size} snapshotů (skutečně {result['snapshots']}) ==")
+        rows = [(f"GET /{name}", stats) for name, stats in result['endpoints'].items()]
+        rows += [(f"/history {name}", stats) for name, stats in result['history_query'].items()]
+        rows.append(("scheduled_position_save", result['scheduled_position_save']))
+        for label, stats in rows:
+            print(f"  {label:32s} {stats['throughput_rps']:>9} req/s  p50 {stats['p50_ms']:>9} ms  "
+                  f"p99 {stats['p99_ms']:>9} ms  chyby {stats['errors']}")
+        print(f"  {'zápis do DB':32s} {result['db_write']['records_per_second']:>9} záznamů/s")
+
+
+def run(args):
+    templates, wallet = None, default_wallet()
+    if args.recording:
+        with open(args.recording) as f:
+            recording = json.load(f)
+        templates = recording['/v5/position/list']['result']['list'] or None
+        wallets = recording['/v5/account/wallet-balance']['result']['list']
+        wallet = wallets[0] if wallets else wallet
+    position_count = args.positions if args.positions is not None else len(templates or []) or 20
+
+    fake = FakeBybit(synthetic_positions(position_count, templates), wallet, args.latency_ms, args.jitter_ms)
+    fake_url = fake.start()
+
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+    # Konfigurace se čte při importu aplikace
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{db_path}",
+        'BYBIT_REST_URL': fake_url,
+        'BYBIT_API_KEY': 'benchmark',
+        'BYBIT_API_SECRET': 'benchmark',
+        'BYBIT_ACCOUNTS': '',
+        'BYBIT_SETTLE_COINS': 'USDT'
+    })
+    import app_gemini as A
+    from werkzeug.serving import make_server
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    A.trader.cache.ttl_seconds = args.cache_ttl
+    A.trader.rate_budget.rate = A.trader.rate_budget.capacity = args.account_rps
+    with A.app.app_context():
+        A.migrate_database()
+
+    server = make_server('127.0.0.1', 0, A.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='benchmark-app', daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = {
+        'meta': {
+            'revision': _git_revision(),
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'params': {key: value for key, value in vars(args).items() if key != 'func'}
+        },
+        'results': {}
+    }
+    try:
+        for size in args.sizes:
+            seed_snapshots(A, size, position_count, templates, args.seed_items)
+            results['results'][str(size)] = benchmark_size(A, base_url, args)
+    finally:
+        server.shutdown()
+        A.write_queue.stop()
+        fake.stop()
+
+    print_results(results)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nVýsledky uloženy do {args.output}.")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_with_baseline(results, json.load(f))
+
+
+def _read_sse(response, events: queue.Queue):
+    # Události /stream do fronty jako (typ, data, čas přijetí)
+    event_type = None
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith('event: '):
+                event_type = line[len('event: '):]
+            elif line.startswith('data: ') and event_type:
+                events.put((event_type, json.loads(line[len('data: '):]), time.perf_counter()))
+                event_type = None
+    except (requests.RequestException, AttributeError, ValueError):
+        pass # spojení zavřené na konci scénáře
+
+
+def _expect_event(events: queue.Queue, predicate, timeout: float) -> Optional[float]:
+    """
+    Čeká na událost, pro kterou platí predicate(typ, data); vrací čas přijetí nebo None.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            event_type, data, received = events.get(timeout=remaining)
+        except queue.Empty:
+            return None
+        if predicate(event_type, data):
+            return received
+
+
+def stream(args):
+    """
+    Projde zprávy position a wallet a výpadek spojení přes lokální WebSocket
+    až do /stream a změří zpoždění od odeslání zprávy po událost SSE.
+    """
+    positions = synthetic_positions(args.positions)
+    fake = FakeBybit(positions, default_wallet(), latency_ms=0.0)
+    fake_ws = FakeBybitWebSocket()
+    fake_url, fake_ws_url = fake.start(), fake_ws.start()
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench-stream-'), 'bench.db')}",
+        'BYBIT_REST_URL': fake_url,
+        'BYBIT_WS_URL': fake_ws_url,
+        'BYBIT_API_KEY': 'benchmark',
+        'BYBIT_API_SECRET': 'benchmark',
+        'BYBIT_ACCOUNTS': ''
+    })
+    import app_gemini as A
+    from werkzeug.serving import make_server
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with A.app.app_context():
+        A.migrate_database()
+    if not A.start_live_stream():
+        sys.exit("Živý stream se nepodařilo spustit.")
+    server = make_server('127.0.0.1', 0, A.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='benchmark-app', daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = {}
+    topics = {'position', 'wallet'}
+    events = queue.Queue()
+    try:
+        if not fake_ws.wait_subscribed(topics, timeout=args.timeout):
+            sys.exit("WebSocket se nepřihlásil k odběru position/wallet.")
+        # Mezi událostmi chodí jen keepalive, limit platí pro navázání spojení
+        response = requests.get(base_url + '/stream', stream=True, timeout=(args.timeout, None))
+        if response.status_code != 200:
+            sys.exit(f"/stream vrátil {response.status_code}.")
+        threading.Thread(target=_read_sse, args=(response, events), name='sse-reader', daemon=True).start()
+        if _expect_event(events, lambda event_type, _: event_type == 'snapshot', args.timeout) is None:
+            sys.exit("/stream neposlal úvodní stav knihy pozic.")
+
+        def step(name: str, topic: str, data: List[Dict], predicate):
+            sent = time.perf_counter()
+            subscribers = fake_ws.publish(topic, data)
+            received = _expect_event(events, predicate, args.timeout) if subscribers else None
+            results[name] = {'ok': received is not None,
+                             'latency_ms': round((received - sent) * 1000, 3) if received is not None else None}
+
+        opened = dict(positions[0], symbol='STREAMUSDT', category='linear')
+        step('position_open', 'position', [opened],
+             lambda event_type, data: event_type == 'position' and any(p['symbol'] == 'STREAMUSDT' for p in data['data']))
+        wallet = dict(default_wallet(), totalEquity="123456.78", accountType='UNIFIED')
+        step('wallet', 'wallet', [wallet],
+             lambda event_type, data: event_type == 'wallet' and data['data']['total_equity'] == "123456.78")
+        step('position_close', 'position', [dict(opened, size="0")],
+             lambda event_type, data: event_type == 'position' and 'STREAMUSDT' in data['removed'])
+
+        # Výpadek spojení: klient se musí znovu připojit, autentizovat a obnovit odběry
+        dropped = time.perf_counter()
+        fake_ws.drop()
+        reconnected = fake_ws.wait_subscribed(topics, connections=2, timeout=args.timeout)
+        results['reconnect'] = {'ok': reconnected,
+                                'latency_ms': round((time.perf_counter() - dropped) * 1000, 3) if reconnected else None}
+        if reconnected:
+            step('position_after_reconnect', 'position', [dict(opened, size="2")],
+                 lambda event_type, data: event_type == 'position' and any(
+                     p['symbol'] == 'STREAMUSDT' and p['size'] == "2" for p in data['data']))
+        response.close()
+    finally:
+        server.shutdown()
+        A.live_stream.stop()
+        fake_ws.stop()
+        fake.stop()
+
+    for name, result in results.items():
+        latency = f"{result['latency_ms']:>9} ms" if result['ok'] else '        -'
+        print(f"  {name:28s} {'OK' if result['ok'] else 'CHYBA':6s} {latency}")
+    if not all(result['ok'] for result in results.values()):
+        sys.exit(1)
+
+
+def record(args):
+    import app_gemini as A
+    if not A.trader:
+        sys.exit("Trading client není inicializován, zkontrolujte API klíče.")
+    recording = {
+        '/v5/position/list': A.trader.dispatcher.call(
+            'get_positions', category=A.config.default_category, settleCoin=args.settle_coin
+        ),
+        '/v5/account/wallet-balance': A.trader.dispatcher.call('get_wallet_balance', accountType="UNIFIED")
+    }
+    with open(args.output, 'w') as f:
+        json.dump(recording, f, indent=2)
+    print(f"Nahrané odpovědi uloženy do {args.output}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark aplikace proti lokální náhradě Bybit API.")
+    commands = parser.add_subparsers(required=True)
+
+    run_parser = commands.add_parser('run', help="Spustí benchmark.")
+    run_parser.add_argument('--sizes', type=lambda value: [int(v) for v in value.split(',')],
+                            default=[10000, 100000, 1000000], help="Počty uložených snapshotů (čárkou oddělené).")
+    run_parser.add_argument('--positions', type=int, default=None, help="Počet otevřených pozic v odpovědích (výchozí 20).")
+    run_parser.add_argument('--recording', help="Soubor z příkazu record; jinak syntetické odpovědi.")
+    run_parser.add_argument('--latency-ms', type=float, default=50.0, help="Latence náhrady API.")
+    run_parser.add_argument('--jitter-ms', type=float, default=10.0, help="Náhodný přídavek k latenci.")
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--requests', type=int, default=2000, help="Počet požadavků na každý endpoint.")
+    run_parser.add_argument('--history-repeats', type=int, default=20, help="Opakování každého dotazu /history.")
+    run_parser.add_argument('--scheduler-runs', type=int, default=200)
+    run_parser.add_argument('--cache-ttl', type=float, default=5.0, help="TTL cache odpovědí API (0 = bez cache).")
+    run_parser.add_argument('--account-rps', type=float, default=10.0, help="Rozpočet požadavků na API za sekundu.")
+    run_parser.add_argument('--no-seed-items', dest='seed_items', action='store_false',
+                            help="Neplnit tabulku position_item (jinak se plní jako při běžném zápisu).")
+    run_parser.add_argument('--db', help="Soubor databáze (zachová se mezi běhy); jinak dočasný.")
+    run_parser.add_argument('--output', help="Uloží výsledky jako JSON.")
+    run_parser.add_argument('--baseline', help="JSON z dřívějšího běhu k porovnání.")
+    run_parser.set_defaults(func=run)
+
+    stream_parser = commands.add_parser('stream', help="Ověří živý stream přes lokální náhradu WebSocketu.")
+    stream_parser.add_argument('--positions', type=int, default=20, help="Počet otevřených pozic v odpovědích REST.")
+    stream_parser.add_argument('--timeout', type=float, default=30.0, help="Limit pro každý krok (sekundy).")
+    stream_parser.set_defaults(func=stream)
+
+    record_parser = commands.add_parser('record', help="Nahraje odpovědi z živého API (jen čtení).")
+    record_parser.add_argument('--output', required=True)
+    record_parser.add_argument('--settle-coin', default="USDT")
+    record_parser.set_defaults(func=record)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()